@@ -4,22 +4,21 @@
 
 import logging
 import sqlite3
-from pathlib import Path
-from db import get_connection, get_all_chat_ids, DB_PATH
-from state import load_user_state
-from helpers_delete import safe_delete
+from db import get_connection, DB_PATH
+from state import load_all_user_states
+from helpers_delete import safe_delete, safe_delete_many
 from telegram import Bot
+from config import get_config
 import asyncio
-import os
-from dotenv import load_dotenv
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Загружаем переменные окружения
-PROJECT_ROOT = Path(__file__).parent.parent
-load_dotenv(PROJECT_ROOT / ".env")
-BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Токен из того же кэшированного конфига, что и у бота (.env в корне проекта и bot/.env)
+BOT_TOKEN = get_config().bot_token
+
+# Сколько пользователей очищается одновременно (запросы к Telegram идут параллельно)
+CLEANUP_CONCURRENCY = 32
 
 
 async def cleanup_user_messages(bot: Bot, chat_id: int, user_state) -> None:
@@ -62,16 +61,12 @@ async def cleanup_user_messages(bot: Bot, chat_id: int, user_state) -> None:
         if user_state.pending_task_message_id:
             all_service_messages.append(user_state.pending_task_message_id)
         
-        for msg_id in all_service_messages:
-            try:
-                await safe_delete(
-                    bot,
-                    user_state.business_connection_id,
-                    chat_id,
-                    msg_id,
-                )
-            except Exception as e:
-                logger.debug(f"  ⚠️ Не удалось удалить служебное сообщение {msg_id}: {e}")
+        await safe_delete_many(
+            bot,
+            user_state.business_connection_id,
+            chat_id,
+            all_service_messages,
+        )
         
         logger.info(f"  ✅ Очищено сообщений для chat_id={chat_id}")
         
@@ -87,30 +82,32 @@ async def cleanup_all_users_and_messages() -> None:
     
     bot = Bot(BOT_TOKEN)
     
-    # Получаем всех пользователей из БД
-    chat_ids = get_all_chat_ids()
-    logger.info(f"📋 Найдено пользователей в БД: {len(chat_ids)}")
+    # Получаем всех пользователей из БД (все состояния — одним запросом)
+    user_states = load_all_user_states()
+    logger.info(f"📋 Найдено пользователей в БД: {len(user_states)}")
     
-    if not chat_ids:
+    if not user_states:
         logger.info("ℹ️ Пользователей не найдено, нечего очищать")
         return
     
-    # Удаляем сообщения для каждого пользователя
-    for chat_id in chat_ids:
-        try:
-            user_state = load_user_state(chat_id)
-            if user_state:
-                await cleanup_user_messages(bot, chat_id, user_state)
-            else:
-                logger.warning(f"⚠️ Не удалось загрузить user_state для chat_id={chat_id}")
-        except Exception as e:
-            logger.error(f"❌ Ошибка при обработке chat_id={chat_id}: {e}", exc_info=True)
+    # Удаляем сообщения пользователей параллельно (не более CLEANUP_CONCURRENCY одновременно)
+    sem = asyncio.Semaphore(CLEANUP_CONCURRENCY)
+    
+    async def _cleanup_one(chat_id: int, user_state) -> None:
+        async with sem:
+            await cleanup_user_messages(bot, chat_id, user_state)
+    
+    results = await asyncio.gather(
+        *(_cleanup_one(chat_id, user_state) for chat_id, user_state in user_states.items()),
+        return_exceptions=True,
+    )
+    for chat_id, result in zip(user_states, results):
+        if isinstance(result, Exception):
+            logger.error(f"❌ Ошибка при обработке chat_id={chat_id}: {result}", exc_info=result)
     
     # Удаляем все записи из БД
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM user_state")
-    deleted_count = cursor.rowcount
+    deleted_count = conn.execute("DELETE FROM user_state").rowcount
     conn.commit()
     conn.close()
     
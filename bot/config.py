@@ -0,0 +1,81 @@
+"""
+Модуль конфигурации бота.
+
+Содержит:
+- Config: настройки бота (токен, версия, параметры фоновых задач)
+- get_config(): однократная загрузка .env и сборка Config (результат кэшируется)
+"""
+
+import logging
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from dotenv import load_dotenv
+
+
+logger = logging.getLogger(__name__)
+
+# Корень проекта (на уровень выше bot/)
+PROJECT_ROOT = Path(__file__).parent.parent
+
+# Файл версии бота
+VERSION_FILE = PROJECT_ROOT / "VERSION"
+
+# .env рядом с ботом (его наличие проверяется при запуске)
+BOT_ENV_PATH = Path(__file__).parent / ".env"
+
+# Параллелизм смены дня по умолчанию (если ROLLOVER_CONCURRENCY не задан или некорректен)
+DEFAULT_ROLLOVER_CONCURRENCY = 20
+
+
+def _positive_int_env(name: str, default: int) -> int:
+    """
+    Читает целое число >= 1 из переменной окружения. Некорректное значение
+    не роняет запуск: пишем предупреждение и берём default; 0 и отрицательные
+    поднимаем до 1 (Semaphore(0) навсегда заблокировал бы смену дня).
+    """
+    raw = os.getenv(name)
+    if raw is None or not raw.strip():
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        logger.warning(f"⚠️ {name}={raw!r} — не целое число, используется {default}")
+        return default
+    if value < 1:
+        logger.warning(f"⚠️ {name}={value} — должно быть не меньше 1, используется 1")
+        return 1
+    return value
+
+
+@dataclass(frozen=True)
+class Config:
+    bot_token: Optional[str]  # токен от @BotFather (None, если не задан)
+    version: str  # версия бота из файла VERSION
+    env_path: Path  # путь к bot/.env
+    rollover_concurrency: int = DEFAULT_ROLLOVER_CONCURRENCY  # сколько пользователей check_day_rollover обрабатывает одновременно
+
+
+@lru_cache(maxsize=1)
+def get_config() -> Config:
+    """
+    Загружает переменные окружения (сначала .env в корне проекта, затем bot/.env)
+    и возвращает настройки. Файлы читаются один раз — повторные вызовы берут результат из кэша.
+    """
+    load_dotenv(PROJECT_ROOT / ".env")
+    load_dotenv(BOT_ENV_PATH)
+
+    try:
+        version = VERSION_FILE.read_text(encoding="utf-8").strip()
+    except Exception:
+        version = "0.0.0-unknown"
+
+    return Config(
+        bot_token=os.getenv("BOT_TOKEN"),
+        version=version,
+        env_path=BOT_ENV_PATH,
+        rollover_concurrency=_positive_int_env("ROLLOVER_CONCURRENCY", DEFAULT_ROLLOVER_CONCURRENCY),
+    )
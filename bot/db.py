@@ -2,29 +2,113 @@
 Модуль для работы с базой данных SQLite.
 
 Содержит:
-- init_db(): инициализация БД и создание таблиц
+- init_db(): инициализация БД (режим WAL) и создание таблиц
+- enable_wal(): включение режима WAL
+- checkpoint_wal(): перенос WAL в основной файл БД и усечение state.db-wal
+- get_connection(): новое соединение (скрипты, транзакции BEGIN IMMEDIATE)
+- shared_connection(): общее постоянное соединение бота (загрузка/сохранение состояний)
 """
 
 import sqlite3
 import json
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional, List
+from typing import Iterator, Optional, List
 
 
 # Путь к файлу БД (в корне проекта)
 PROJECT_ROOT = Path(__file__).parent.parent
 DB_PATH = PROJECT_ROOT / "bot.db"
 
+# Размер области mmap для чтения БД (байт)
+MMAP_SIZE = 128 * 1024 * 1024
+
+# Размер страничного кэша соединения (КиБ; в PRAGMA передаётся отрицательным числом)
+CACHE_SIZE_KIB = 20000
+
+
+# Общее соединение открывается один раз и используется из event loop и из потока
+# фоновой записи состояний, поэтому доступ к нему сериализуется блокировкой
+_shared_conn: Optional[sqlite3.Connection] = None
+_shared_lock = threading.RLock()
+
+
+def _connect(check_same_thread: bool = True) -> sqlite3.Connection:
+    """Открывает соединение с БД и настраивает его"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=check_same_thread)
+    # В режиме WAL synchronous=NORMAL безопасен: fsync делается на checkpoint, а не на каждый commit
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # Чтение страниц через отображение файла в память (без копирования в буферы)
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    # Постоянное соединение держит горячие страницы между запросами — даём кэшу места
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+    return conn
+
 
 def get_connection():
     """Создает и возвращает соединение с БД"""
-    return sqlite3.connect(DB_PATH)
+    return _connect()
+
+
+@contextmanager
+def shared_connection() -> Iterator[sqlite3.Connection]:
+    """
+    Выдаёт общее постоянное соединение (открывается при первом использовании)
+    и удерживает блокировку на время работы с ним.
+    Не закрывайте его — соединение живёт до close_shared_connection().
+    """
+    global _shared_conn
+    with _shared_lock:
+        if _shared_conn is None:
+            _shared_conn = _connect(check_same_thread=False)
+        yield _shared_conn
+
+
+def close_shared_connection() -> None:
+    """Закрывает общее соединение (при остановке бота)"""
+    global _shared_conn
+    with _shared_lock:
+        if _shared_conn is not None:
+            _shared_conn.close()
+            _shared_conn = None
+
+
+def enable_wal() -> str:
+    """
+    Переводит БД в режим WAL (настройка хранится в самом файле БД).
+    Возвращает итоговый journal_mode.
+    """
+    conn = get_connection()
+    try:
+        return conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def checkpoint_wal() -> Optional[tuple]:
+    """
+    Переносит накопленный WAL в основной файл БД и усекает state.db-wal
+    (PRAGMA wal_checkpoint(TRUNCATE)). Использует отдельное соединение,
+    чтобы не держать блокировку общего соединения на время checkpoint.
+    Возвращает (busy, страниц в WAL, перенесено страниц).
+    """
+    conn = get_connection()
+    try:
+        return conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    finally:
+        conn.close()
 
 
-def init_db():
+def init_db() -> str:
     """
     Инициализирует базу данных и создает таблицу user_state, если её нет.
+    Сначала переводит БД в режим WAL (миграции ниже уже идут в нём).
+    Возвращает итоговый journal_mode.
     """
+    journal_mode = enable_wal()
+    
     conn = get_connection()
     cursor = conn.cursor()
     
@@ -53,18 +137,25 @@ def init_db():
     """)
     
     # Добавляем колонки, если их нет (для существующих БД)
-    for column in ["tag_checklists", "last_closed_date", "last_opened_date", "timezone_offset_minutes", "next_rollover_job_name", "day_end_time"]:
+    for column in ["tag_checklists", "last_closed_date", "last_opened_date", "timezone_offset_minutes", "next_rollover_job_name", "day_end_time", "next_close_utc"]:
         try:
             if column == "timezone_offset_minutes":
                 cursor.execute(f"ALTER TABLE user_state ADD COLUMN {column} INTEGER DEFAULT 0")
+            elif column == "next_close_utc":
+                cursor.execute(f"ALTER TABLE user_state ADD COLUMN {column} INTEGER")
             else:
                 cursor.execute(f"ALTER TABLE user_state ADD COLUMN {column} TEXT")
         except sqlite3.OperationalError:
             # Колонка уже существует - это нормально
             pass
     
+    # Индекс для отбора кандидатов на смену дня (check_day_rollover)
+    cursor.execute("DROP INDEX IF EXISTS idx_user_state_rollover")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_state_next_close ON user_state(next_close_utc)")
+    
     conn.commit()
     conn.close()
+    return journal_mode
 
 
 def get_all_chat_ids() -> List[int]:
@@ -72,10 +163,7 @@ def get_all_chat_ids() -> List[int]:
     Возвращает список всех chat_id из базы данных.
     """
     conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT chat_id FROM user_state")
-    rows = cursor.fetchall()
+    rows = conn.execute("SELECT chat_id FROM user_state").fetchall()
     conn.close()
     
     return [row[0] for row in rows]
@@ -87,10 +175,7 @@ def delete_user_state(chat_id: int) -> bool:
     Возвращает True, если запись была удалена, False если не найдена.
     """
     conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("DELETE FROM user_state WHERE chat_id = ?", (chat_id,))
-    deleted = cursor.rowcount > 0
+    deleted = conn.execute("DELETE FROM user_state WHERE chat_id = ?", (chat_id,)).rowcount > 0
     
     conn.commit()
     conn.close()
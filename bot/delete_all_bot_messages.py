@@ -5,19 +5,15 @@
 
 import logging
 import asyncio
-import os
-from pathlib import Path
-from dotenv import load_dotenv
 from telegram import Bot
 from telegram.error import TelegramError
+from config import get_config
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Загружаем переменные окружения
-PROJECT_ROOT = Path(__file__).parent.parent
-load_dotenv(PROJECT_ROOT / ".env")
-BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Токен из того же кэшированного конфига, что и у бота (.env в корне проекта и bot/.env)
+BOT_TOKEN = get_config().bot_token
 
 
 async def delete_bot_messages_for_chat(bot: Bot, chat_id: int, business_connection_id: str = None) -> None:
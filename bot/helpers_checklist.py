@@ -4,12 +4,14 @@
 
 import logging
 import asyncio
-from datetime import datetime
+import sqlite3
+from datetime import date, datetime
 from typing import Optional, Tuple
 from telegram import InputChecklist, InputChecklistTask
 
 # Импорты из других модулей (будут добавлены после создания)
-from state import UserState, TagChecklistState, TaskItem, save_user_state
+from db import get_connection
+from state import UserState, TagChecklistState, TaskItem, load_user_state, save_user_state, flush_now
 from helpers_text import get_user_local_date
 
 logger = logging.getLogger(__name__)
@@ -50,7 +52,7 @@ def get_human_date_from_iso(date_iso: str) -> str:
         return "Дата не указана"
     
     try:
-        date_obj = datetime.strptime(date_iso, "%Y-%m-%d")
+        date_obj = date.fromisoformat(date_iso)
         MONTH_NAMES_RU = [
             "", "января", "февраля", "марта", "апреля", "мая", "июня",
             "июля", "августа", "сентября", "октября", "ноября", "декабря"
@@ -71,7 +73,7 @@ def get_checklist_title_from_date(date_iso: str) -> str:
         return "#дата"
     
     try:
-        date_obj = datetime.strptime(date_iso, "%Y-%m-%d")
+        date_obj = date.fromisoformat(date_iso)
         
         # Сокращенные названия месяцев
         MONTH_SHORT = [
@@ -96,6 +98,7 @@ async def create_checklist_for_user(
     bot,
     chat_id: int,
     user_state: UserState,
+    now_utc: Optional[datetime] = None,
 ) -> None:
     """
     Создаёт нативный чеклист для данного пользователя, если он ещё не создан.
@@ -106,6 +109,7 @@ async def create_checklist_for_user(
     - сохраняет checklist_message_id, дату и список tasks в user_state
     
     ВАЖНО: Использует блокировку для предотвращения одновременного создания чеклистов.
+    now_utc — момент обработки обновления (чтобы не брать текущее время повторно).
     """
     # Получаем или создаем блокировку для этого пользователя (thread-safe)
     async with _lock_creation_lock:
@@ -133,11 +137,11 @@ async def create_checklist_for_user(
                     logger.debug(f"📅 Используем установленную дату для нового чеклиста: {current_user_date}")
                 else:
                     # Дата не установлена - вычисляем актуальную локальную дату пользователя
-                    current_user_date = get_user_local_date(user_state)
+                    current_user_date = get_user_local_date(user_state, now_utc)
                     logger.debug(f"📅 Вычислена дата для нового чеклиста: {current_user_date}")
             else:
                 # Обновляем существующий чеклист - проверяем, не изменилась ли дата
-                current_user_date = get_user_local_date(user_state)
+                current_user_date = get_user_local_date(user_state, now_utc)
             
             # 3. Формируем title в формате #4дек_чт
             checklist_title = get_checklist_title_from_date(current_user_date)
@@ -163,30 +167,28 @@ async def create_checklist_for_user(
             
             # 5. Если чеклиста ещё нет — создаём новый
             # ВАЖНО: Используем атомарную транзакцию ДО отправки в Telegram, чтобы предотвратить дублирование
-            from db import get_connection
-            import sqlite3
-            from state import load_user_state
             
             # Обновляем дату только если она изменилась или не была установлена
             if user_state.date != current_user_date:
                 user_state.date = current_user_date
                 save_user_state(chat_id, user_state)
             
+            # Атомарная проверка читает строку прямо из SQLite — дописываем отложенные сохранения
+            flush_now(chat_id)
+            
             # КРИТИЧЕСКИ ВАЖНО: Используем BEGIN IMMEDIATE для эксклюзивной блокировки БД
             # Это гарантирует, что только один запрос сможет проверить и установить checklist_message_id
             conn = get_connection()
             try:
-                cursor = conn.cursor()
                 # BEGIN IMMEDIATE блокирует БД для записи, другие запросы будут ждать
-                cursor.execute("BEGIN IMMEDIATE")
+                conn.execute("BEGIN IMMEDIATE")
                 
                 # Проверяем, не был ли чеклист уже создан другим запросом
                 # ВАЖНО: проверяем как на реальный message_id (> 0), так и на маркер -1 (в процессе создания)
-                cursor.execute(
+                row = conn.execute(
                     "SELECT checklist_message_id FROM user_state WHERE chat_id = ?",
                     (chat_id,)
-                )
-                row = cursor.fetchone()
+                ).fetchone()
                 
                 if row and row[0] is not None:
                     existing_message_id = row[0]
@@ -224,11 +226,10 @@ async def create_checklist_for_user(
                 
                 # Устанавливаем временный маркер, чтобы другие запросы знали, что чеклист создается
                 # Используем специальное значение -1 как маркер "в процессе создания"
-                cursor.execute(
+                rows_updated = conn.execute(
                     "UPDATE user_state SET checklist_message_id = -1 WHERE chat_id = ? AND checklist_message_id IS NULL",
                     (chat_id,)
-                )
-                rows_updated = cursor.rowcount
+                ).rowcount
                 conn.commit()
                 
                 if rows_updated == 0:
@@ -299,10 +300,10 @@ async def create_checklist_for_user(
             if not tasks:
                 logger.info(f"⏭️ Нет невыполненных задач для создания чеклиста для chat_id={chat_id}, пропускаем")
                 # Снимаем маркер
+                flush_now(chat_id)
                 conn = get_connection()
                 try:
-                    cursor = conn.cursor()
-                    cursor.execute(
+                    conn.execute(
                         "UPDATE user_state SET checklist_message_id = NULL WHERE chat_id = ? AND checklist_message_id = -1",
                         (chat_id,)
                     )
@@ -328,14 +329,13 @@ async def create_checklist_for_user(
             )
             
             # Обновляем checklist_message_id с реальным значением (заменяем маркер -1)
+            flush_now(chat_id)
             conn = get_connection()
             try:
-                cursor = conn.cursor()
-                cursor.execute(
+                rows_updated = conn.execute(
                     "UPDATE user_state SET checklist_message_id = ? WHERE chat_id = ? AND checklist_message_id = -1",
                     (msg.message_id, chat_id)
-                )
-                rows_updated = cursor.rowcount
+                ).rowcount
                 conn.commit()
                 
                 if rows_updated == 0:
@@ -544,7 +544,6 @@ async def add_task_to_tag_checklist(
         # ВАЖНО: перезагружаем состояние перед созданием, чтобы избежать дублирования при конкурентных запросах
         if tag not in user_state.tag_checklists:
             # Перезагружаем состояние из БД перед созданием, чтобы убедиться, что чеклист не был создан другим запросом
-            from state import load_user_state
             fresh_user_state = load_user_state(chat_id)
             if fresh_user_state and tag in fresh_user_state.tag_checklists:
                 # Чеклист был создан другим запросом - используем его
@@ -4,13 +4,13 @@
 
 import logging
 from pathlib import Path
-from datetime import datetime, timedelta, time
+from datetime import date, datetime, timedelta, time
 from typing import List, Optional, Dict
 
-from state import UserState, TaskItem, TagChecklistState, save_user_state
-from helpers_checklist import get_today_human_date, get_human_date_from_iso, create_checklist_for_user, add_task_to_tag_checklist, rebuild_tag_checklist_for_user
-from helpers_text import get_user_local_date
-from helpers_delete import safe_delete
+from state import UserState, TaskItem, TagChecklistState, load_user_state, save_user_state
+from helpers_checklist import get_today_human_date, get_human_date_from_iso, get_checklist_title_from_date, create_checklist_for_user, add_task_to_tag_checklist, rebuild_tag_checklist_for_user
+from helpers_text import get_user_local_date, parse_time_parts
+from helpers_delete import safe_delete_many
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +18,10 @@ logger = logging.getLogger(__name__)
 PROJECT_ROOT = Path(__file__).parent.parent
 ARCHIVE_DIR = PROJECT_ROOT / "archive"
 
+# Минут в сутках и в половине суток (для нормализации UTC-смещения)
+MINUTES_PER_DAY = 24 * 60
+HALF_DAY_MINUTES = MINUTES_PER_DAY // 2
+
 
 def compute_local_datetime_and_offset(now_utc: datetime, user_time_str: str) -> tuple[datetime, int]:
     """
@@ -37,23 +41,18 @@ def compute_local_datetime_and_offset(now_utc: datetime, user_time_str: str) ->
     - Вычисляет смещение так, чтобы (now_utc + offset).time() == (HH:MM)
     - Нормализует смещение к диапазону [-12ч, +12ч]
     """
-    from helpers_text import parse_time_string
-    
     # Парсим время
-    parsed = parse_time_string(user_time_str)
-    if not parsed:
+    parts = parse_time_parts(user_time_str)
+    if parts is None:
         raise ValueError(f"Неверный формат времени: {user_time_str}")
     
-    h, m = map(int, parsed.split(":"))
+    h, m = parts
     user_minutes = h * 60 + m
     utc_minutes = now_utc.hour * 60 + now_utc.minute
     
-    # Вычисляем raw_delta
-    raw_delta = (user_minutes - utc_minutes) % 1440
-    
-    # Нормализуем к диапазону [-12h, +12h]
-    # (raw_delta + 720) % 1440 - 720 переводит [0, 1440) в [-720, 720)
-    delta = (raw_delta + 720) % 1440 - 720
+    # Разница, нормализованная к диапазону [-12h, +12h) одним взятием по модулю:
+    # сдвиг на полсуток переводит любую разницу в [0, сутки), обратный сдвиг — в [-720, 720)
+    delta = (user_minutes - utc_minutes + HALF_DAY_MINUTES) % MINUTES_PER_DAY - HALF_DAY_MINUTES
     
     # Вычисляем локальное datetime
     local_dt = now_utc + timedelta(minutes=delta)
@@ -61,43 +60,19 @@ def compute_local_datetime_and_offset(now_utc: datetime, user_time_str: str) ->
     return local_dt, delta
 
 
-def calc_minutes_until_midnight_from_user_time(user_state: UserState) -> int:
+def calc_seconds_until_local_midnight(user_state: UserState, now_utc: Optional[datetime] = None) -> float:
     """
-    Вычисляет, через сколько минут наступит локальная полуночь пользователя.
-    Если user_state.time установлено, использует его как текущее локальное время пользователя.
-    Иначе использует текущее локальное время (datetime.utcnow() + timezone_offset_minutes).
+    Вычисляет, через сколько секунд наступит следующая локальная полночь пользователя
+    (по timezone_offset_minutes, с точностью до секунд).
     
-    Примеры:
-    - Если user_state.time = "23:58" → 2 минуты
-    - Если user_state.time = "22:30" → 90 минут
-    - Если user_state.time = "00:00" → 24 * 60 минут (целые сутки)
+    Результат всегда в диапазоне (0, 24ч]: ровно в полночь — следующая полночь через сутки.
+    now_utc может быть как наивным (UTC), так и с tzinfo.
     """
-    from datetime import datetime, timedelta
-    
-    # Если есть user_state.time, используем его как текущее локальное время пользователя
-    if user_state.time:
-        try:
-            h, m = map(int, user_state.time.split(":"))
-            current_minutes = h * 60 + m
-        except Exception:
-            # Если не удалось распарсить, вычисляем на основе offset
-            now = datetime.utcnow()
-            offset_minutes = getattr(user_state, "timezone_offset_minutes", 0) or 0
-            user_now = now + timedelta(minutes=offset_minutes)
-            current_minutes = user_now.hour * 60 + user_now.minute
-    else:
-        # Вычисляем текущее локальное время пользователя
-        now = datetime.utcnow()
-        offset_minutes = getattr(user_state, "timezone_offset_minutes", 0) or 0
-        user_now = now + timedelta(minutes=offset_minutes)
-        current_minutes = user_now.hour * 60 + user_now.minute
-    
-    # Вычисляем минуты до полуночи
-    minutes_to_midnight = (24 * 60 - current_minutes) % (24 * 60)
-    if minutes_to_midnight == 0:
-        minutes_to_midnight = 24 * 60  # Если уже полночь, следующая полночь через 24 часа
-    
-    return minutes_to_midnight
+    if now_utc is None:
+        now_utc = datetime.utcnow()
+    user_now = now_utc + timedelta(minutes=user_state.timezone_offset_minutes or 0)
+    next_midnight = datetime.combine(user_now.date() + timedelta(days=1), time.min, tzinfo=user_now.tzinfo)
+    return (next_midnight - user_now).total_seconds()
 
 
 def generate_daily_report(user_state: UserState, report_date: str = None) -> str:
@@ -121,7 +96,6 @@ def generate_daily_report(user_state: UserState, report_date: str = None) -> str
         return "**Дата не указана**\n\nНет задач для отчёта."
     
     # Используем формат "#6дек_сб" вместо "6 декабря"
-    from helpers_checklist import get_checklist_title_from_date
     human_date = get_checklist_title_from_date(date_for_report)
     
     # Логирование для диагностики
@@ -176,7 +150,7 @@ def generate_daily_report(user_state: UserState, report_date: str = None) -> str
     return report_text
 
 
-async def close_day_for_user(bot, chat_id: int, user_state: UserState = None) -> None:
+async def close_day_for_user(bot, chat_id: int, user_state: UserState = None) -> Optional[UserState]:
     """
     Закрывает день для пользователя:
     - Создаёт отчёт (только выполненные задачи) - ДО фильтрации задач
@@ -187,19 +161,21 @@ async def close_day_for_user(bot, chat_id: int, user_state: UserState = None) ->
     
     ВАЖНО: использует user_state.date (который установлен через get_user_local_date)
     Если user_state не передан, загружает актуальное состояние из базы.
+    
+    Возвращает тот же (обновлённый) user_state — перечитывать его не нужно;
+    None, только если состояние не удалось загрузить.
     """
     try:
         # Загружаем актуальное состояние, если не передано
         if user_state is None:
-            from state import load_user_state
             user_state = load_user_state(chat_id)
             if not user_state:
                 logger.error(f"❌ Не удалось загрузить user_state для chat_id={chat_id}")
-                return
+                return None
         
         if not user_state.date:
             logger.info(f"📌 У chat_id={chat_id} нет установленной даты, нечего закрывать")
-            return
+            return user_state
         
         # Проверяем и логируем текущее состояние перед генерацией отчёта
         current_calculated_date = get_user_local_date(user_state)
@@ -208,16 +184,16 @@ async def close_day_for_user(bot, chat_id: int, user_state: UserState = None) ->
         # ЗАЩИТА ОТ ДВОЙНОГО ЗАКРЫТИЯ: проверяем, не закрыт ли уже день для этой даты
         if user_state.last_closed_date == current_calculated_date:
             logger.info(f"⏭️ День уже закрыт для chat_id={chat_id}, last_closed_date={user_state.last_closed_date}, current_date={current_calculated_date}")
-            return
+            return user_state
         
         # Сохраняем дату закрытого дня ДО обновления на новую дату
         closed_date = user_state.date
         
         # Обновляем user_state.date на актуальную вычисленную дату (для нового дня)
+        # Сохраняется вместе с остальными изменениями в конце закрытия дня — одной записью
         if user_state.date != current_calculated_date:
             logger.info(f"🔄 Обновление даты для нового дня: {user_state.date} → {current_calculated_date}")
             user_state.date = current_calculated_date
-            save_user_state(chat_id, user_state)
         
         # Подсчитываем выполненные задачи ДО генерации отчёта
         completed_before = sum(1 for task in user_state.tasks if task.done)
@@ -259,26 +235,16 @@ async def close_day_for_user(bot, chat_id: int, user_state: UserState = None) ->
         except Exception as e:
             logger.error(f"❌ Ошибка при сохранении отчёта в файл для chat_id={chat_id}: {e}", exc_info=True)
         
-        # 4. Удаляем нативный дневной чеклист
+        # 4-5. Удаляем нативный дневной чеклист и все теговые чеклисты (параллельно)
+        checklist_ids = []
         if user_state.checklist_message_id:
-            await safe_delete(
-                bot,
-                user_state.business_connection_id,
-                chat_id,
-                user_state.checklist_message_id,
-            )
-            logger.info(f"✅ Дневной чеклист удалён для chat_id={chat_id}, message_id={user_state.checklist_message_id}")
-        
-        # 5. Удаляем все теговые чеклисты
+            checklist_ids.append(user_state.checklist_message_id)
         for tag, tag_state in user_state.tag_checklists.items():
             if tag_state.checklist_message_id:
-                await safe_delete(
-                    bot,
-                    user_state.business_connection_id,
-                    chat_id,
-                    tag_state.checklist_message_id,
-                )
-                logger.info(f"✅ Теговый чеклист '{tag}' удалён для chat_id={chat_id}, message_id={tag_state.checklist_message_id}")
+                checklist_ids.append(tag_state.checklist_message_id)
+        if checklist_ids:
+            await safe_delete_many(bot, user_state.business_connection_id, chat_id, checklist_ids)
+            logger.info(f"✅ Чеклисты (дневной и теговые) удалены для chat_id={chat_id}, message_ids={checklist_ids}")
         
         # 6. ЯВНО разделяем задачи на выполненные и невыполненные
         # Дневные задачи
@@ -357,6 +323,8 @@ async def close_day_for_user(bot, chat_id: int, user_state: UserState = None) ->
         
     except Exception as e:
         logger.error(f"❌ Ошибка при закрытии дня для chat_id={chat_id}: {e}", exc_info=True)
+    
+    return user_state
 
 
 def get_user_local_datetime(user_state: UserState, now: Optional[datetime] = None) -> datetime:
@@ -365,7 +333,7 @@ def get_user_local_datetime(user_state: UserState, now: Optional[datetime] = Non
     """
     if now is None:
         now = datetime.utcnow()
-    offset_minutes = getattr(user_state, "timezone_offset_minutes", 0) or 0
+    offset_minutes = user_state.timezone_offset_minutes or 0
     return now + timedelta(minutes=offset_minutes)
 
 
@@ -390,12 +358,11 @@ async def check_and_handle_day_end_for_user(bot, chat_id: int, user_state: UserS
         local_time = user_now.time()
         
         # Парсим day_end_time
-        try:
-            h, m = map(int, user_state.day_end_time.split(":"))
-            day_end_time_obj = time(h, m)
-        except Exception:
+        parts = parse_time_parts(user_state.day_end_time)
+        if parts is None:
             logger.warning(f"⚠️ Неверный формат day_end_time для chat_id={chat_id}: {user_state.day_end_time}")
             return
+        day_end_time_obj = time(*parts)
         
         # Условия для авто-закрытия:
         # 1. Если local_date == last_closed_date → день уже закрыт, ничего не делаем
@@ -422,15 +389,8 @@ async def check_and_handle_day_end_for_user(bot, chat_id: int, user_state: UserS
         # Время наступило и день ещё не закрыт - закрываем день
         logger.info(f"🔄 AUTO_DAY_CLOSE chat_id={chat_id} date={local_date} (время достигло day_end_time: {local_time} >= {day_end_time_obj})")
         
-        # Закрываем день (close_day_for_user сам установит last_closed_date)
-        await close_day_for_user(bot, chat_id, user_state)
-        
-        # Перезагружаем состояние после закрытия
-        from state import load_user_state
-        user_state = load_user_state(chat_id)
-        if not user_state:
-            logger.error(f"❌ Не удалось загрузить user_state после close_day_for_user для chat_id={chat_id}")
-            return
+        # Закрываем день (close_day_for_user сам установит last_closed_date и вернёт обновлённое состояние)
+        user_state = await close_day_for_user(bot, chat_id, user_state)
         
         # Проверяем, что день действительно закрыт
         if user_state.last_closed_date != local_date:
@@ -438,8 +398,7 @@ async def check_and_handle_day_end_for_user(bot, chat_id: int, user_state: UserS
             return
         
         # Вычисляем дату нового дня (следующий день после закрытого)
-        from datetime import datetime, timedelta
-        closed_date_obj = datetime.strptime(user_state.last_closed_date, "%Y-%m-%d").date()
+        closed_date_obj = date.fromisoformat(user_state.last_closed_date)
         next_date_obj = closed_date_obj + timedelta(days=1)
         next_date = next_date_obj.isoformat()
         
@@ -449,13 +408,7 @@ async def check_and_handle_day_end_for_user(bot, chat_id: int, user_state: UserS
             return
         
         # Открываем новый день (start_new_day_for_user сам установит last_opened_date)
-        await start_new_day_for_user(bot, chat_id, user_state)
-        
-        # Перезагружаем состояние после открытия
-        user_state = load_user_state(chat_id)
-        if not user_state:
-            logger.error(f"❌ Не удалось загрузить user_state после start_new_day_for_user для chat_id={chat_id}")
-            return
+        user_state = await start_new_day_for_user(bot, chat_id, user_state)
         
         # Проверяем, что last_opened_date обновлён (start_new_day_for_user должен был это сделать)
         if user_state.last_opened_date != next_date:
@@ -511,13 +464,7 @@ async def check_and_handle_new_day(bot, chat_id: int, user_state: UserState) ->
         # ВАЖНО: close_day_for_user сам установит last_closed_date, не трогаем его здесь
         if user_state.last_closed_date != user_state.date:
             logger.info(f"🔄 Закрытие дня для chat_id={chat_id}: last_closed_date={user_state.last_closed_date}, date={user_state.date}")
-            await close_day_for_user(bot, chat_id, user_state)
-            # Перезагружаем состояние после закрытия
-            from state import load_user_state
-            user_state = load_user_state(chat_id)
-            if not user_state:
-                logger.error(f"❌ Не удалось загрузить user_state после close_day_for_user для chat_id={chat_id}")
-                return
+            user_state = await close_day_for_user(bot, chat_id, user_state)
         
         # Открываем новый день
         # ВАЖНО: start_new_day_for_user сам установит date и last_opened_date, не трогаем их здесь
@@ -529,7 +476,7 @@ async def check_and_handle_new_day(bot, chat_id: int, user_state: UserState) ->
         logger.error(f"❌ Ошибка при проверке смены дня для chat_id={chat_id}: {e}", exc_info=True)
 
 
-async def start_new_day_for_user(bot, chat_id: int, user_state: UserState) -> None:
+async def start_new_day_for_user(bot, chat_id: int, user_state: UserState) -> UserState:
     """
     Создаёт новый день для пользователя:
     - Вычисляет новую дату на основе локального времени пользователя
@@ -538,13 +485,13 @@ async def start_new_day_for_user(bot, chat_id: int, user_state: UserState) -> No
     
     ВАЖНО: предполагает, что в user_state к моменту вызова уже хранятся только невыполненные задачи
     (после close_day_for_user). Выполненные задачи уже "ушли" в текстовый отчёт.
+    
+    Возвращает тот же (обновлённый) user_state — перечитывать его не нужно.
     """
     try:
         # Вычисляем текущую дату пользователя на основе локального времени
-        from datetime import datetime, timedelta
-        
         now = datetime.utcnow()
-        offset_minutes = getattr(user_state, "timezone_offset_minutes", 0) or 0
+        offset_minutes = user_state.timezone_offset_minutes or 0
         user_now = now + timedelta(minutes=offset_minutes)
         today_date = user_now.date().isoformat()
         
@@ -560,9 +507,6 @@ async def start_new_day_for_user(bot, chat_id: int, user_state: UserState) -> No
         # ВАЖНО: устанавливаем last_opened_date сразу после обновления даты
         user_state.last_opened_date = today_date
         
-        # ВАЖНО: сохраняем дату ДО создания чеклиста, чтобы create_checklist_for_user использовал правильную дату
-        save_user_state(chat_id, user_state)
-        
         # Проверяем, что работаем только с невыполненными задачами
         # (которые остались после close_day_for_user)
         pending_daily_count = len(user_state.tasks)
@@ -573,9 +517,12 @@ async def start_new_day_for_user(bot, chat_id: int, user_state: UserState) -> No
         if not user_state.tasks:
             first_task = TaskItem(item_id=1, text="улыбнуться себе в зеркало", done=False)
             user_state.tasks = [first_task]
-            save_user_state(chat_id, user_state)
             logger.info(f"➕ Добавлена автоматическая задача для нового дня")
         
+        # ВАЖНО: сохраняем дату (и задачи) ДО создания чеклиста — одной записью,
+        # чтобы create_checklist_for_user использовал правильную дату
+        save_user_state(chat_id, user_state)
+        
         # Создаём новый дневной чеклист из невыполненных задач
         # (checklist_message_id уже сброшен в close_day_for_user)
         # ВАЖНО: create_checklist_for_user теперь использует актуальную дату из user_state.date
@@ -601,6 +548,8 @@ async def start_new_day_for_user(bot, chat_id: int, user_state: UserState) -> No
         
     except Exception as e:
         logger.error(f"❌ Ошибка при создании нового дня для chat_id={chat_id}: {e}", exc_info=True)
+    
+    return user_state
 
 
 async def handle_user_midnight(context) -> None:
@@ -608,23 +557,19 @@ async def handle_user_midnight(context) -> None:
     Job, которая вызывается в 'полночь' пользователя:
     - закрывает день
     - открывает новый
-    - перепланирует себя ещё через 24 часа
+    - перепланирует себя через schedule_user_midnight_job на следующую локальную полночь
     """
     try:
-        from telegram.ext import CallbackContext
-        
         # Получаем данные из job
         data = context.job.data or {} if hasattr(context, 'job') else {}
         chat_id = data.get("chat_id")
         if not chat_id:
-            logger.warning(f"⚠️ handle_user_midnight: chat_id отсутствует в data")
+            logger.warning("⚠️ handle_user_midnight: chat_id отсутствует в data")
             return
         
-        from state import load_user_state, save_user_state
-        
         user_state = load_user_state(chat_id)
         if not user_state:
-            logger.warning(f"⚠️ handle_user_midnight: user_state не найден для chat_id={chat_id}")
+            logger.warning("⚠️ handle_user_midnight: user_state не найден для chat_id=%s", chat_id)
             return
         
         # Получаем bot из context
@@ -633,114 +578,112 @@ async def handle_user_midnight(context) -> None:
             bot = getattr(context.application, 'bot', None)
         
         if not bot:
-            logger.error(f"❌ handle_user_midnight: не удалось получить bot из context для chat_id={chat_id}")
+            logger.error("❌ handle_user_midnight: не удалось получить bot из context для chat_id=%s", chat_id)
             return
         
-        logger.info(f"🕛 Смена дня для пользователя chat_id={chat_id} (midnight job)")
+        logger.info("🕛 Смена дня для пользователя chat_id=%s (midnight job)", chat_id)
         
         # ЗАЩИТА ОТ ДВОЙНОГО ЗАКРЫТИЯ: вычисляем текущую дату пользователя
-        from datetime import datetime, timedelta
         now = datetime.utcnow()
-        offset_minutes = getattr(user_state, "timezone_offset_minutes", 0) or 0
+        offset_minutes = user_state.timezone_offset_minutes or 0
         user_now = now + timedelta(minutes=offset_minutes)
         current_local_date = user_now.date().isoformat()
         
         # Если день уже закрыт для этой даты, пропускаем
         if user_state.last_closed_date == current_local_date:
-            logger.info(f"⏭️ День уже закрыт для chat_id={chat_id}, last_closed_date={user_state.last_closed_date}, current_date={current_local_date}")
+            logger.info("⏭️ День уже закрыт для chat_id=%s, last_closed_date=%s, current_date=%s", chat_id, user_state.last_closed_date, current_local_date)
             # Всё равно перепланируем job на следующий день
-            from helpers_daily import schedule_user_midnight_job
-            job_queue = getattr(context, 'job_queue', None) or (getattr(context.application, 'job_queue', None) if hasattr(context, 'application') else None)
+            job_queue = context.job_queue
             if job_queue:
                 schedule_user_midnight_job(job_queue, chat_id, user_state)
             return
         
-        # 1. Закрываем день
-        await close_day_for_user(bot, chat_id, user_state)
-        
-        # Перезагружаем состояние после закрытия дня
-        user_state = load_user_state(chat_id)
-        if not user_state:
-            logger.error(f"❌ handle_user_midnight: не удалось загрузить user_state после close_day_for_user для chat_id={chat_id}")
-            return
+        # 1. Закрываем день (возвращается обновлённое состояние — перечитывать не нужно)
+        user_state = await close_day_for_user(bot, chat_id, user_state)
         
         # Проверяем, что день действительно закрыт
         if user_state.last_closed_date != current_local_date:
-            logger.warning(f"⚠️ После close_day_for_user last_closed_date не обновлён: ожидали {current_local_date}, получили {user_state.last_closed_date}")
+            logger.warning("⚠️ После close_day_for_user last_closed_date не обновлён: ожидали %s, получили %s", current_local_date, user_state.last_closed_date)
         
         # Вычисляем дату нового дня (следующий день после закрытого)
-        closed_date_obj = datetime.strptime(user_state.last_closed_date, "%Y-%m-%d").date()
+        closed_date_obj = date.fromisoformat(user_state.last_closed_date)
         next_date_obj = closed_date_obj + timedelta(days=1)
         next_date = next_date_obj.isoformat()
         
         # ЗАЩИТА ОТ ДВОЙНОГО ОТКРЫТИЯ: проверяем, не открыт ли уже день для этой даты
         if user_state.last_opened_date == next_date:
-            logger.info(f"⏭️ Новый день уже открыт для chat_id={chat_id}, last_opened_date={user_state.last_opened_date}, next_date={next_date}")
+            logger.info("⏭️ Новый день уже открыт для chat_id=%s, last_opened_date=%s, next_date=%s", chat_id, user_state.last_opened_date, next_date)
             # Всё равно перепланируем job на следующий день
-            from helpers_daily import schedule_user_midnight_job
-            job_queue = getattr(context, 'job_queue', None) or (getattr(context.application, 'job_queue', None) if hasattr(context, 'application') else None)
+            job_queue = context.job_queue
             if job_queue:
                 schedule_user_midnight_job(job_queue, chat_id, user_state)
             return
         
         # 2. Открываем новый день
-        await start_new_day_for_user(bot, chat_id, user_state)
-        
-        # Перезагружаем состояние после открытия дня
-        user_state = load_user_state(chat_id)
-        if not user_state:
-            logger.error(f"❌ handle_user_midnight: не удалось загрузить user_state после start_new_day_for_user для chat_id={chat_id}")
-            return
+        user_state = await start_new_day_for_user(bot, chat_id, user_state)
         
         # ВАЖНО: last_opened_date уже установлен в start_new_day_for_user, не трогаем его здесь
         
-        logger.info(f"🔄 AUTO_NEW_DAY chat_id={chat_id} date={next_date} completed_daily={len([t for t in user_state.tasks if t.done])} pending_daily={len([t for t in user_state.tasks if not t.done])} tag_checklists={len(user_state.tag_checklists)}")
-        
-        # 3. Перепланируем следующий запуск через 24 часа
-        job_queue = getattr(context, 'job_queue', None)
-        if not job_queue and hasattr(context, 'application'):
-            job_queue = getattr(context.application, 'job_queue', None)
+        if logger.isEnabledFor(logging.INFO):
+            completed_daily = sum(1 for t in user_state.tasks if t.done)
+            logger.info(
+                "🔄 AUTO_NEW_DAY chat_id=%s date=%s completed_daily=%s pending_daily=%s tag_checklists=%s",
+                chat_id, next_date, completed_daily, len(user_state.tasks) - completed_daily, len(user_state.tag_checklists),
+            )
         
+        # 3. Перепланируем следующий запуск на следующую локальную полночь
+        # (считаем от текущего времени, а не "+24 часа", чтобы задержки не накапливались)
+        job_queue = context.job_queue
         if job_queue:
-            job_name = f"user_midnight_{chat_id}"
-            
-            job_queue.run_once(
-                handle_user_midnight,
-                when=24 * 60 * 60,  # 24 часа в секундах
-                name=job_name,
-                data={"chat_id": chat_id},
-            )
-            
-            user_state.next_rollover_job_name = job_name
-            save_user_state(chat_id, user_state)
-            logger.info(f"✅ Следующий midnight job запланирован для chat_id={chat_id} через 24 часа")
+            schedule_user_midnight_job(job_queue, chat_id, user_state)
         else:
-            logger.error(f"❌ handle_user_midnight: job_queue отсутствует для chat_id={chat_id}")
+            logger.error("❌ handle_user_midnight: job_queue отсутствует для chat_id=%s", chat_id)
         
     except Exception as e:
-        logger.error(f"❌ Ошибка в handle_user_midnight: {e}", exc_info=True)
+        logger.error("❌ Ошибка в handle_user_midnight: %s", e, exc_info=True)
 
 
-def schedule_user_midnight_job(job_queue, chat_id: int, user_state: UserState) -> None:
+def midnight_job_name(chat_id: int) -> str:
+    """Постоянное имя midnight job'а чата (у каждого чата не больше одного такого job'а)"""
+    return f"user_midnight_{chat_id}"
+
+
+def schedule_user_midnight_job(
+    job_queue,
+    chat_id: int,
+    user_state: UserState,
+    now_utc: Optional[datetime] = None,
+    replace_existing: bool = True,
+) -> None:
     """
     Ставит/переставляет job смены дня для конкретного пользователя
-    на 'его полуночь', исходя из user_state.time как текущего времени.
+    на 'его полуночь', исходя из timezone_offset_minutes и текущего времени UTC
+    (поэтому при восстановлении job'ов после перезапуска задержка тоже точная).
+    Job ищется по постоянному имени midnight_job_name(chat_id), поэтому повторный
+    вызов заменяет старый job, а не добавляет второй.
+    now_utc — текущий момент, если вызывающий код уже его получил.
+    replace_existing=False пропускает поиск старых job'ов (get_jobs_by_name перебирает
+    все job'ы очереди) — для массового восстановления при запуске, когда их заведомо нет.
     """
     try:
-        # 0. Если есть старый job — снимаем
-        if user_state.next_rollover_job_name:
-            try:
-                jobs = job_queue.get_jobs_by_name(user_state.next_rollover_job_name)
-                for job in jobs:
-                    job.schedule_removal()
-                logger.info(f"🗑️ Удалён старый midnight job '{user_state.next_rollover_job_name}' для chat_id={chat_id}")
-            except Exception as e:
-                logger.warning(f"⚠️ Не удалось удалить старый job '{user_state.next_rollover_job_name}': {e}")
-        
-        minutes_to_midnight = calc_minutes_until_midnight_from_user_time(user_state)
-        delay_seconds = minutes_to_midnight * 60
-        
-        job_name = f"user_midnight_{chat_id}"
+        job_name = midnight_job_name(chat_id)
+        
+        # 0. Если есть старый job — снимаем (и по сохранённому имени, если оно отличалось)
+        if replace_existing:
+            old_names = {job_name}
+            if user_state.next_rollover_job_name:
+                old_names.add(user_state.next_rollover_job_name)
+            for old_name in old_names:
+                try:
+                    jobs = job_queue.get_jobs_by_name(old_name)
+                    for job in jobs:
+                        job.schedule_removal()
+                    if jobs:
+                        logger.info("🗑️ Удалён старый midnight job '%s' для chat_id=%s", old_name, chat_id)
+                except Exception as e:
+                    logger.warning("⚠️ Не удалось удалить старый job '%s': %s", old_name, e)
+        
+        delay_seconds = calc_seconds_until_local_midnight(user_state, now_utc)
         
         job_queue.run_once(
             handle_user_midnight,
@@ -749,10 +692,11 @@ def schedule_user_midnight_job(job_queue, chat_id: int, user_state: UserState) -
             data={"chat_id": chat_id},
         )
         
-        user_state.next_rollover_job_name = job_name
-        from state import save_user_state
-        save_user_state(chat_id, user_state)
+        # Имя постоянное — сохраняем состояние, только если оно действительно изменилось
+        if user_state.next_rollover_job_name != job_name:
+            user_state.next_rollover_job_name = job_name
+            save_user_state(chat_id, user_state)
         
-        logger.info(f"✅ Midnight job запланирован для chat_id={chat_id}: через {minutes_to_midnight} минут (время пользователя: {user_state.time})")
+        logger.info("✅ Midnight job запланирован для chat_id=%s: через %.1f минут (смещение: %s мин)", chat_id, delay_seconds / 60, user_state.timezone_offset_minutes)
     except Exception as e:
-        logger.error(f"❌ Ошибка в schedule_user_midnight_job для chat_id={chat_id}: {e}", exc_info=True)
+        logger.error("❌ Ошибка в schedule_user_midnight_job для chat_id=%s: %s", chat_id, e, exc_info=True)
@@ -2,10 +2,18 @@
 Модуль для безопасного удаления сообщений.
 """
 
+import asyncio
 import logging
+from typing import Iterable
 
 logger = logging.getLogger(__name__)
 
+# Сколько удалений выполняется одновременно (лимиты Telegram API на бота)
+DELETE_CONCURRENCY = 8
+
+# Максимум message_ids в одном запросе deleteBusinessMessages (ограничение Bot API)
+DELETE_BATCH_SIZE = 100
+
 
 async def safe_delete(bot, business_connection_id: str, chat_id: int, message_id: int) -> None:
     """Безопасно удаляет business сообщение, игнорируя ошибки"""
@@ -18,3 +26,41 @@ async def safe_delete(bot, business_connection_id: str, chat_id: int, message_id
     except Exception as e:
         logger.warning(f"⚠️ Не удалось удалить message_id={message_id}: {e}")
 
+
+async def safe_delete_many(bot, business_connection_id: str, chat_id: int, message_ids: Iterable[int]) -> None:
+    """
+    Безопасно удаляет несколько business сообщений одного чата, игнорируя ошибки.
+    Сообщения удаляются одним запросом deleteBusinessMessages на каждые
+    DELETE_BATCH_SIZE id; если пачка не удалилась целиком (например, одно из
+    сообщений уже удалено), её сообщения удаляются по одному — параллельно,
+    не более DELETE_CONCURRENCY запросов одновременно.
+    """
+    message_ids = list(dict.fromkeys(message_ids))
+    if not message_ids:
+        return
+    if len(message_ids) == 1:
+        await safe_delete(bot, business_connection_id, chat_id, message_ids[0])
+        return
+    
+    failed = []
+    for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+        batch = message_ids[start:start + DELETE_BATCH_SIZE]
+        try:
+            await bot.delete_business_messages(
+                business_connection_id=business_connection_id,
+                message_ids=batch,
+            )
+        except Exception as e:
+            logger.debug(f"Пакетное удаление {len(batch)} сообщений для chat_id={chat_id} не удалось ({e}), удаляю по одному")
+            failed.extend(batch)
+    
+    if not failed:
+        return
+    
+    sem = asyncio.Semaphore(DELETE_CONCURRENCY)
+    
+    async def _delete(message_id: int) -> None:
+        async with sem:
+            await safe_delete(bot, business_connection_id, chat_id, message_id)
+    
+    await asyncio.gather(*(_delete(message_id) for message_id in failed), return_exceptions=True)
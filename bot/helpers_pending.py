@@ -11,7 +11,7 @@ from telegram.ext import ContextTypes, CallbackContext
 from state import UserState, TaskItem, load_user_state, save_user_state
 from helpers_checklist import create_checklist_for_user, add_task_to_tag_checklist, update_checklist_for_user
 from helpers_tags import build_tags_keyboard
-from helpers_delete import safe_delete
+from helpers_delete import safe_delete, safe_delete_many
 from helpers_text import extract_task_text_from_business_message, normalize_tag
 
 logger = logging.getLogger(__name__)
@@ -66,8 +66,7 @@ async def finalize_task_without_tag(bot, chat_id: int, user_state: UserState) ->
         messages_to_delete.append(user_state.pending_task_message_id)
     messages_to_delete.extend(user_state.pending_service_message_ids)
     
-    for msg_id in messages_to_delete:
-        await safe_delete(bot, user_state.business_connection_id, chat_id, msg_id)
+    await safe_delete_many(bot, user_state.business_connection_id, chat_id, messages_to_delete)
     
     # Очищаем pending поля
     user_state.pending_task_text = None
@@ -95,8 +94,7 @@ async def cancel_pending_task(bot, chat_id: int, user_state: UserState, update:
             messages_to_delete.append(user_state.pending_task_message_id)
         messages_to_delete.extend(user_state.pending_service_message_ids)
         
-        for msg_id in messages_to_delete:
-            await safe_delete(bot, user_state.business_connection_id, chat_id, msg_id)
+        await safe_delete_many(bot, user_state.business_connection_id, chat_id, messages_to_delete)
         
         # 3. Очистить pending-поля БЕЗ добавления задачи в чеклист
         user_state.pending_task_text = None
@@ -144,8 +142,7 @@ async def finalize_task_with_tag(bot, chat_id: int, user_state: UserState, tag:
     if additional_message_id and additional_message_id not in messages_to_delete:
         messages_to_delete.append(additional_message_id)
     
-    for msg_id in messages_to_delete:
-        await safe_delete(bot, user_state.business_connection_id, chat_id, msg_id)
+    await safe_delete_many(bot, user_state.business_connection_id, chat_id, messages_to_delete)
     
     # Очищаем pending поля
     user_state.pending_task_text = None
@@ -210,7 +207,7 @@ async def handle_task_addition(update: Update, context: ContextTypes.DEFAULT_TYP
         
         # Проверяем, не ждём ли мы тег
         if user_state.awaiting_tag:
-            # Обрабатываем как ввод тега (будет обработано в handle_all_updates)
+            # Обрабатываем как ввод тега (будет обработано в handle_business_message)
             return
         
         # СНАЧАЛА проверяем медиа без текста и удаляем сразу
@@ -243,10 +240,10 @@ async def handle_task_addition(update: Update, context: ContextTypes.DEFAULT_TYP
         if user_state.pending_task_text:
             await cancel_pending_confirm_job(context.job_queue, user_state)
             # Удаляем старые pending сообщения
-            for msg_id in user_state.pending_service_message_ids:
-                await safe_delete(context.bot, user_state.business_connection_id, chat_id, msg_id)
+            old_pending_ids = list(user_state.pending_service_message_ids)
             if user_state.pending_task_message_id:
-                await safe_delete(context.bot, user_state.business_connection_id, chat_id, user_state.pending_task_message_id)
+                old_pending_ids.append(user_state.pending_task_message_id)
+            await safe_delete_many(context.bot, user_state.business_connection_id, chat_id, old_pending_ids)
             user_state.pending_service_message_ids.clear()
         
         # 1. Убедиться, что чеклист создан
@@ -378,13 +375,10 @@ async def handle_tag_input(update: Update, context: ContextTypes.DEFAULT_TYPE, u
             save_user_state(chat_id, user_state)
             return
         
-        # Добавляем/поднимаем тег в истории
+        # Добавляем/поднимаем тег в истории (самый старый тег вытесняется очередью)
         if tag in user_state.tags_history:
             user_state.tags_history.remove(tag)
-        user_state.tags_history.insert(0, tag)
-        # Оставляем только последние 30 тегов
-        if len(user_state.tags_history) > 30:
-            user_state.tags_history = user_state.tags_history[:30]
+        user_state.tags_history.appendleft(tag)
         
         # Финализируем задачу с тегом (добавляет в чеклист по тегу и очищает pending)
         # Передаем message_id сообщения с тегом для удаления
@@ -405,9 +399,7 @@ async def handle_tag_select_callback(update: Update, context: ContextTypes.DEFAU
     # Поднимаем тег в истории
     if tag in user_state.tags_history:
         user_state.tags_history.remove(tag)
-    user_state.tags_history.insert(0, tag)
-    if len(user_state.tags_history) > 30:
-        user_state.tags_history = user_state.tags_history[:30]
+    user_state.tags_history.appendleft(tag)
     
     # Финализируем задачу с тегом (добавляет в чеклист по тегу и очищает pending)
     await finalize_task_with_tag(context.bot, chat_id, user_state, tag)
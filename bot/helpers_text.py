@@ -5,7 +5,7 @@
 import logging
 import re
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 
 from state import UserState
 
@@ -14,18 +14,28 @@ logger = logging.getLogger(__name__)
 # Константы
 MAX_TAG_LENGTH = 250  # Максимальная длина тега для защиты от очень длинных строк
 
+# Формат времени HH:MM (компилируется один раз при импорте)
+_TIME_RE = re.compile(r"^\s*(\d{1,2}):(\d{2})\s*$")
 
-def parse_time_string(text: str) -> Optional[str]:
-    """Парсит строку вида HH:MM и возвращает нормализованное время или None"""
-    text = text.strip()
-    m = re.match(r"^(\d{1,2}):(\d{2})$", text)
+
+def parse_time_parts(text: str) -> Optional[Tuple[int, int]]:
+    """Парсит строку вида HH:MM и возвращает (часы, минуты) или None"""
+    m = _TIME_RE.match(text)
     if not m:
         return None
     h = int(m.group(1))
     mnt = int(m.group(2))
-    if not (0 <= h <= 23 and 0 <= mnt <= 59):
+    if h > 23 or mnt > 59:
+        return None
+    return h, mnt
+
+
+def parse_time_string(text: str) -> Optional[str]:
+    """Парсит строку вида HH:MM и возвращает нормализованное время или None"""
+    parts = parse_time_parts(text)
+    if parts is None:
         return None
-    return f"{h:02d}:{mnt:02d}"
+    return f"{parts[0]:02d}:{parts[1]:02d}"
 
 
 def normalize_tag(raw: str) -> Optional[str]:
@@ -204,11 +214,11 @@ def get_user_local_date(user_state: UserState, now: Optional[datetime] = None) -
         now = datetime.utcnow()
     
     # Применяем смещение часового пояса
-    offset_minutes = getattr(user_state, "timezone_offset_minutes", 0) or 0
+    offset_minutes = user_state.timezone_offset_minutes or 0
     user_now = now + timedelta(minutes=offset_minutes)
     
     # День пользователя = дата его локального времени
     user_date = user_now.date()
     
-    return user_date.strftime("%Y-%m-%d")
+    return user_date.isoformat()
 
@@ -24,37 +24,60 @@ Telegram Business бот-чеклист.
 # Импорты и общая конфигурация
 # ===============================
 
+import asyncio
+import atexit
 import logging
 import os
+import queue
 import re
-import shutil
-from datetime import datetime, time
-from pathlib import Path
-from typing import Optional
-from dotenv import load_dotenv
+import sqlite3
+import threading
+from datetime import datetime, time, timedelta, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from time import strftime
+from typing import Dict, Optional, Tuple
 from telegram import Update
 from telegram.error import TelegramError
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     CallbackContext,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
-    TypeHandler,
+    MessageHandler,
+    filters,
 )
 
 # Импорт состояния из отдельного модуля
-from state import UserState, load_user_state, save_user_state, STATE
-from db import init_db, DB_PATH
+from state import (
+    UserState,
+    load_user_state,
+    load_scheduled_user_states,
+    load_rollover_candidates,
+    next_rollover_after,
+    save_user_state,
+    set_user_time_info,
+    flush_now,
+    STATE,
+    start_state_writer,
+    stop_state_writer,
+)
+from db import init_db, checkpoint_wal, close_shared_connection, DB_PATH
+from config import get_config
 
 # Импорт хелперов из отдельных модулей
-from helpers_text import parse_time_string, normalize_tag
+from helpers_text import parse_time_parts, normalize_tag
 from helpers_checklist import get_today_human_date, create_checklist_for_user, handle_checklist_state_update
-from helpers_daily import close_day_for_user, start_new_day_for_user, check_and_handle_new_day
+from helpers_daily import (
+    close_day_for_user,
+    start_new_day_for_user,
+    check_and_handle_new_day,
+    schedule_user_midnight_job,
+)
 from helpers_text import get_user_local_date
-from db import get_all_chat_ids
 from helpers_tags import on_tags_page_next, on_tags_page_prev
-from helpers_delete import safe_delete
+from helpers_delete import safe_delete, safe_delete_many
 from helpers_pending import (
     handle_task_addition,
     handle_task_skip_callback,
@@ -69,45 +92,91 @@ from helpers_pending import (
 # Константы и глобальные настройки
 # ===============================
 
-# Определяем корень проекта (на уровень выше bot/)
-PROJECT_ROOT = Path(__file__).parent.parent
-
-# Загружаем переменные окружения из корня проекта
-load_dotenv(PROJECT_ROOT / ".env")
-
-# Версия бота
-VERSION_FILE = PROJECT_ROOT / "VERSION"
+# Версия бота (get_config загружает .env один раз и кэширует настройки)
+BOT_VERSION = get_config().version
+
+# Настройка логирования: вызовы logger.* только кладут запись в очередь,
+# а запись в файл/консоль выполняет QueueListener в отдельном потоке
+# (event loop не блокируется на дисковом I/O). bot.log ротируется по размеру.
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_file_handler = RotatingFileHandler('bot.log', maxBytes=10 * 1024 * 1024, backupCount=5, encoding='utf-8')
+_log_file_handler.setFormatter(_log_formatter)
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(_log_formatter)
+
+_log_queue = queue.SimpleQueue()
+_log_queue_handler = QueueHandler(_log_queue)
+# Сообщение (и traceback) форматируется в QueueHandler, остальное — в обработчиках listener'а
+_log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[_log_queue_handler])
+
+_log_listener = QueueListener(_log_queue, _log_file_handler, _log_stream_handler, respect_handler_level=True)
+_log_listener.start()
+# При выходе дописываем оставшиеся в очереди записи
+atexit.register(_log_listener.stop)
 
-try:
-    BOT_VERSION = VERSION_FILE.read_text(encoding="utf-8").strip()
-except Exception:
-    BOT_VERSION = "0.0.0-unknown"
-
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
 # Константы
 TAGS_PER_PAGE = 3  # Количество тегов на странице
 
+# Основной механизм смены дня — индивидуальные midnight job'ы (schedule_user_midnight_job);
+# check_day_rollover лишь страхует их (например, пропущенные во время простоя бота).
+# Проверка не опрашивает БД по расписанию, а просыпается к ближайшему next_close_utc
+# (с запасом ROLLOVER_GRACE, чтобы midnight job успел отработать первым),
+# но не реже чем раз в ROLLOVER_MAX_DELAY
+ROLLOVER_JOB_NAME = "check_day_rollover"
+ROLLOVER_GRACE = 120  # секунд
+ROLLOVER_MAX_DELAY = 3600  # секунд
+# Если смена дня у кого-то не удалась (ошибка Telegram, занятая БД), проверка
+# повторяется раньше — не дожидаясь следующего next_close_utc
+ROLLOVER_RETRY_DELAY = 60  # секунд
+
+# Типы обновлений, которые запрашиваются у Telegram (у остальных нет обработчиков)
+ALLOWED_UPDATES = (Update.MESSAGE, Update.BUSINESS_MESSAGE, Update.CALLBACK_QUERY)
+
+# Как часто переносить WAL в основной файл БД (чтобы state.db-wal не разрастался)
+WAL_CHECKPOINT_INTERVAL = 60  # секунд
+
+# Сколько последних бэкапов state.db хранить при запуске
+BACKUP_KEEP = 7
+
+# Сколько раз AIORateLimiter повторяет запрос после ответа 429 (RetryAfter)
+RATE_LIMIT_MAX_RETRIES = 2
+
+# Команды бизнес-чата (CommandHandler не видит business_message):
+# "/force_close", "/force_newday", "/время", "/time", в т.ч. с префиксом "@bot "
+_CMD_RE = re.compile(r'^\s*(?:@\w+\s*)?/(force_close|force_newday|время|time)\b', re.IGNORECASE)
+
+# Поля business_message, наличие которых означает событие изменения чеклиста.
+# checklist_tasks_done — единственное из них, что есть в Message PTB 22.x, поэтому
+# проверяется первым; остальные оставлены на случай новых версий Bot API.
+# (Объекты PTB используют __slots__, так что пересечение с __dict__ здесь невозможно.)
+_CHECKLIST_ATTRS = (
+    "checklist_tasks_done",
+    "new_checklist_item_state",
+    "checklist_item_state",
+    "new_checklist_item",
+)
+
+# Поля, которые фильтр is_system_or_service_business_message проверяет напрямую
+# (вместо перебора атрибутов сообщения): сам чеклист и его изменения...
+_SERVICE_FILTER_CHECKLIST_ATTRS = ("checklist", "checklist_tasks_done", "checklist_tasks_added")
+# ...и медиа, без которых сообщение без текста считается служебным
+_MEDIA_ATTRS = ("photo", "voice", "video", "document", "audio", "sticker")
+
 # ===============================
 # Хелперы: фильтрация системных сообщений
 # ===============================
 
 def get_or_create_user_state(update: Update) -> Optional[UserState]:
     """Получает или создаёт UserState для пользователя"""
-    # Диагностическое логирование
-    logger.info(f"DEBUG: get_or_create_user_state вызван")
-    logger.info(f"DEBUG: update.business_message={bool(update.business_message)}")
-    logger.info(f"DEBUG: update.message={bool(update.message)}")
-    logger.info(f"DEBUG: update.callback_query={bool(update.callback_query)}")
+    # Диагностическое логирование (вызывается на каждый апдейт — только на уровне DEBUG)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "get_or_create_user_state: business_message=%s, message=%s, callback_query=%s",
+            bool(update.business_message), bool(update.message), bool(update.callback_query),
+        )
     
     bmsg = update.business_message
     if not bmsg:
@@ -117,11 +186,10 @@ def get_or_create_user_state(update: Update) -> Optional[UserState]:
     chat_id = bmsg.chat.id
     bconn = bmsg.business_connection_id
     
-    logger.info(f"DEBUG: chat_id={chat_id}, business_connection_id={bconn}")
+    logger.debug("get_or_create_user_state: chat_id=%s, business_connection_id=%s", chat_id, bconn)
 
     if not bconn:
-        print("NO BUSINESS CONNECTION ID — MESSAGE IGNORED")
-        logger.error(f"DEBUG: business_connection_id отсутствует для chat_id={chat_id}")
+        logger.error("❌ business_connection_id отсутствует для chat_id=%s — сообщение проигнорировано", chat_id)
         return None
 
     user_state = load_user_state(chat_id)
@@ -134,7 +202,6 @@ def get_or_create_user_state(update: Update) -> Optional[UserState]:
             checklist_message_id=None,
             date=None,
             tasks=[],
-            service_message_ids=[],
             pending_task_text=None,
             pending_task_message_id=None,
             pending_service_message_ids=[],
@@ -159,36 +226,30 @@ def is_system_or_service_business_message(bmsg) -> bool:
     НЕЛЬЗЯ фильтровать, иначе чеклист перестаёт работать.
     """
     # 1. Сообщения от самого бота — фильтруем
-    if getattr(bmsg, "from_user", None) and getattr(bmsg.from_user, "is_bot", False):
+    from_user = bmsg.from_user
+    if from_user is not None and from_user.is_bot:
         return True
 
     # 2. Автоматические пересылки
-    if getattr(bmsg, "is_automatic_forward", False):
+    if bmsg.is_automatic_forward:
         return True
 
-    # ❗️ 3. НЕ фильтруем события чеклиста — возвращаем False
+    # 3. Есть текст/подпись — обычное сообщение пользователя (самый частый случай),
+    # дальнейшие проверки не нужны
+    if bmsg.text or bmsg.caption:
+        return False
+
+    # ❗️ 4. НЕ фильтруем события чеклиста — возвращаем False
     # Это важные события для логики чеклистов — всегда пропускаем
-    if getattr(bmsg, "checklist", None) \
-       or getattr(bmsg, "checklist_tasks_done", None) \
-       or getattr(bmsg, "checklist_tasks_added", None):
+    if any(getattr(bmsg, attr, None) for attr in _SERVICE_FILTER_CHECKLIST_ATTRS):
         return False
 
-    # 4. Если нет текста/подписи и нет медиа — это сервисное сообщение
-    has_text = bool(getattr(bmsg, "text", None) or getattr(bmsg, "caption", None))
-    has_media = any([
-        getattr(bmsg, "photo", None),
-        getattr(bmsg, "voice", None),
-        getattr(bmsg, "video", None),
-        getattr(bmsg, "document", None),
-        getattr(bmsg, "audio", None),
-        getattr(bmsg, "sticker", None),
-    ])
-
-    if not has_text and not has_media:
-        return True
+    # 5. Если нет текста/подписи и нет медиа — это сервисное сообщение
+    # (генератор останавливается на первом найденном медиа)
+    has_media = any(getattr(bmsg, attr, None) for attr in _MEDIA_ATTRS)
 
-    # 5. Всё остальное → не системное
-    return False
+    # 6. Всё остальное → не системное
+    return not has_media
 
 
 # ===============================
@@ -218,32 +279,34 @@ async def handle_first_message(update: Update, context: ContextTypes.DEFAULT_TYP
         logger.error(f"❌ Ошибка при отправке первого сообщения: {e}", exc_info=True)
         return
     
-    # отправляем второе сообщение с запросом времени
+    # отправляем второе сообщение с запросом времени и одновременно удаляем
+    # первое сообщение пользователя (второе приветствие ждёт только первое —
+    # порядок сообщений в чате сохраняется)
     welcome_2_text = (
         "Укажи текущее время в формате HH:MM ⏰"
     )
-    try:
-        welcome_2 = await context.bot.send_message(
+    welcome_2, _ = await asyncio.gather(
+        context.bot.send_message(
             business_connection_id=user_state.business_connection_id,
             chat_id=chat_id,
             text=welcome_2_text,
-        )
-    except Exception as e:
-        logger.error(f"❌ Ошибка при отправке второго сообщения: {e}", exc_info=True)
+        ),
+        safe_delete(
+            context.bot,
+            user_state.business_connection_id,
+            chat_id,
+            business_msg.message_id,
+        ),
+        return_exceptions=True,
+    )
+    if isinstance(welcome_2, Exception):
+        logger.error(f"❌ Ошибка при отправке второго сообщения: {welcome_2}", exc_info=welcome_2)
         return
     
     # Сохраняем ID служебных сообщений
     user_state.service_message_ids.append(welcome_1.message_id)
     user_state.service_message_ids.append(welcome_2.message_id)
     
-    # удаляем первое сообщение пользователя
-    await safe_delete(
-        context.bot,
-        user_state.business_connection_id,
-        chat_id,
-        business_msg.message_id,
-    )
-    
     user_state.asked_for_time = True
     user_state.waiting_for_time = True
     # Обновляем состояние
@@ -261,29 +324,45 @@ async def handle_time_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     chat_id = business_msg.chat.id
 
-    # Добавляем само сообщение /время в служебные, чтобы потом удалить
-    user_state.service_message_ids.append(business_msg.message_id)
-
     # Переводим пользователя в режим "запрос времени"
     user_state.asked_for_time = True           # уже спрашивали, но сейчас заново
     user_state.waiting_for_time = True
     user_state.time = None                     # сбрасываем старое время, будем ставить новое
 
-    # Спрашиваем новое время
-    msg = await context.bot.send_message(
-        business_connection_id=user_state.business_connection_id,
-        chat_id=chat_id,
-        text="⏰ Обновим время чек-листа.\nОтправь новое время в формате HH:MM, например 09:30.",
+    # Спрашиваем новое время и одновременно удаляем само сообщение /время
+    # (запросы независимы, поэтому не ждём их по очереди)
+    msg, _ = await asyncio.gather(
+        context.bot.send_message(
+            business_connection_id=user_state.business_connection_id,
+            chat_id=chat_id,
+            text="⏰ Обновим время чек-листа.\nОтправь новое время в формате HH:MM, например 09:30.",
+        ),
+        safe_delete(
+            context.bot,
+            user_state.business_connection_id,
+            chat_id,
+            business_msg.message_id,
+        ),
+        return_exceptions=True,
     )
-    user_state.service_message_ids.append(msg.message_id)
+    if isinstance(msg, Exception):
+        logger.error(f"❌ Ошибка при отправке запроса времени для chat_id={chat_id}: {msg}", exc_info=msg)
+    else:
+        user_state.service_message_ids.append(msg.message_id)
 
     save_user_state(chat_id, user_state)
 
 
-async def handle_force_close(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def handle_force_close(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    user_state: UserState,
+) -> None:
     """
     Обработчик команды /force_close — принудительно закрывает текущий день.
     Вызывает close_day_for_user для закрытия дня и формирования отчёта.
+    Вызывается из handle_business_message, user_state — уже загруженное состояние чата
+    (события чеклиста обновляют этот же объект, перечитывать его не нужно).
     """
     try:
         business_msg = update.business_message
@@ -294,22 +373,12 @@ async def handle_force_close(update: Update, context: ContextTypes.DEFAULT_TYPE)
         chat_id = business_msg.chat.id
         logger.info(f"🔄 Команда /force_close вызвана для chat_id={chat_id}")
         
-        # Загружаем актуальное состояние перед закрытием дня
-        # (чтобы получить все последние синхронизации выполненных задач)
-        from state import load_user_state
-        from helpers_daily import close_day_for_user
-        
-        fresh_user_state = load_user_state(chat_id)
-        if not fresh_user_state:
-            logger.error(f"❌ Не удалось загрузить user_state для chat_id={chat_id}")
-            return
-        
         # Используем текущий user_state.date как "день, который закрываем"
-        close_date = fresh_user_state.date
+        close_date = user_state.date
         if not close_date:
             logger.warning(f"⚠️ У пользователя chat_id={chat_id} нет установленной даты")
             await context.bot.send_message(
-                business_connection_id=fresh_user_state.business_connection_id,
+                business_connection_id=user_state.business_connection_id,
                 chat_id=chat_id,
                 text="❌ Не установлена дата. Используйте команду /время для установки времени.",
             )
@@ -323,12 +392,14 @@ async def handle_force_close(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # - оставит в состоянии только невыполненные задачи
         # - обновит last_closed_date
         # - сохранит состояние
-        await close_day_for_user(context.bot, chat_id, fresh_user_state)
+        await close_day_for_user(context.bot, chat_id, user_state)
+        # Закрытие дня должно попасть в БД до ответа пользователю
+        flush_now(chat_id)
         
         logger.info(f"FORCE_DAY_CLOSE chat_id={chat_id} date={close_date}")
         
         await context.bot.send_message(
-            business_connection_id=fresh_user_state.business_connection_id,
+            business_connection_id=user_state.business_connection_id,
             chat_id=chat_id,
             text=f"✅ День закрыт. Используйте /force_newday для открытия нового дня.",
         )
@@ -337,10 +408,15 @@ async def handle_force_close(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.error(f"❌ Ошибка в handle_force_close для chat_id={business_msg.chat.id if business_msg else 'unknown'}: {e}", exc_info=True)
 
 
-async def handle_force_newday(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def handle_force_newday(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    user_state: UserState,
+) -> None:
     """
     Обработчик команды /force_newday — принудительно открывает новый день.
     Вызывает start_new_day_for_user для создания новых чеклистов из невыполненных задач.
+    Вызывается из handle_business_message, user_state — уже загруженное состояние чата.
     """
     try:
         business_msg = update.business_message
@@ -351,34 +427,20 @@ async def handle_force_newday(update: Update, context: ContextTypes.DEFAULT_TYPE
         chat_id = business_msg.chat.id
         logger.info(f"🔄 Команда /force_newday вызвана для chat_id={chat_id}")
         
-        # Загружаем актуальное состояние (после close_day_for_user там только невыполненные задачи)
-        from state import load_user_state
-        from helpers_daily import start_new_day_for_user
-        
-        fresh_user_state = load_user_state(chat_id)
-        if not fresh_user_state:
-            logger.error(f"❌ Не удалось загрузить user_state для chat_id={chat_id}")
-            return
-        
         # start_new_day_for_user:
         # - обновит дату на актуальную (вычисленную на основе локального времени)
         # - создаст новые чеклисты из невыполненных задач (которые остались после close_day_for_user)
-        # - сохранит состояние
-        await start_new_day_for_user(context.bot, chat_id, fresh_user_state)
+        # - сохранит состояние и вернёт его же
+        user_state = await start_new_day_for_user(context.bot, chat_id, user_state)
         
-        # Перезагружаем состояние после открытия нового дня
-        fresh_user_state = load_user_state(chat_id)
-        if fresh_user_state:
-            new_date = fresh_user_state.date
-            logger.info(f"FORCE_NEW_DAY chat_id={chat_id} date={new_date}")
-            
-            await context.bot.send_message(
-                business_connection_id=fresh_user_state.business_connection_id,
-                chat_id=chat_id,
-                text=f"✅ Новый день открыт (дата: {new_date}).",
-            )
-        else:
-            logger.error(f"❌ Не удалось загрузить user_state после start_new_day_for_user для chat_id={chat_id}")
+        new_date = user_state.date
+        logger.info(f"FORCE_NEW_DAY chat_id={chat_id} date={new_date}")
+        
+        await context.bot.send_message(
+            business_connection_id=user_state.business_connection_id,
+            chat_id=chat_id,
+            text=f"✅ Новый день открыт (дата: {new_date}).",
+        )
         
     except Exception as e:
         logger.error(f"❌ Ошибка в handle_force_newday для chat_id={business_msg.chat.id if business_msg else 'unknown'}: {e}", exc_info=True)
@@ -405,9 +467,8 @@ async def apply_user_time(
     
     chat_id = business_msg.chat.id
     
-    # Используем общую функцию для установки времени
-    from state import set_user_time_info
-    success = set_user_time_info(chat_id, time_str)
+    # Используем общую функцию для установки времени (с уже полученным now_utc)
+    success = set_user_time_info(chat_id, time_str, now_utc)
     
     if not success:
         return False
@@ -421,31 +482,20 @@ async def apply_user_time(
     user_state.last_opened_date = user_state.date  # инициализируем
     
     # Поставить job на смену дня для этого пользователя
-    job_queue = None
-    try:
-        if hasattr(context, "application") and context.application:
-            job_queue = getattr(context.application, "job_queue", None)
-            if job_queue is None and hasattr(context.application, "job_queue"):
-                job_queue = context.application.job_queue
-        if job_queue is None and hasattr(context, "job_queue"):
-            job_queue = context.job_queue
-    except Exception as e:
-        logger.warning(f"⚠️ Ошибка при получении job_queue: {e}")
-    
+    # (context.job_queue — это application.job_queue, как и в helpers_pending)
+    job_queue = context.job_queue
     if job_queue:
-        from helpers_daily import schedule_user_midnight_job
-        parsed = parse_time_string(time_str)
-        logger.info(f"📅 Создание midnight job для chat_id={chat_id}, время={parsed}, offset={user_state.timezone_offset_minutes} минут")
+        logger.info(f"📅 Создание midnight job для chat_id={chat_id}, время={user_state.day_end_time}, offset={user_state.timezone_offset_minutes} минут")
         try:
-            schedule_user_midnight_job(job_queue, chat_id, user_state)
+            schedule_user_midnight_job(job_queue, chat_id, user_state, now_utc)
         except Exception as e:
             logger.error(f"❌ Ошибка при создании midnight job: {e}", exc_info=True)
     else:
         logger.warning(f"⚠️ job_queue отсутствует при установке времени для chat_id={chat_id}")
-        logger.warning(f"⚠️ Резервный механизм check_day_rollover будет проверять смену дня каждые 60 секунд")
+        logger.warning(f"⚠️ Резервный механизм check_day_rollover подхватит смену дня не позже чем через {ROLLOVER_MAX_DELAY} секунд")
     
     # Создаем первый чеклист, если его еще нет
-    await create_checklist_for_user(context.bot, chat_id, user_state)
+    await create_checklist_for_user(context.bot, chat_id, user_state, now_utc)
     
     # Сохраняем состояние
     save_user_state(chat_id, user_state)
@@ -468,14 +518,15 @@ async def handle_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE,
             chat_id=chat_id,
             text="Пожалуйста, отправь время в формате HH:MM, например 09:30.",
         )
-        # Убеждаемся, что остаемся в режиме ожидания времени
-        user_state.waiting_for_time = True
-        save_user_state(chat_id, user_state)
+        # Остаемся в режиме ожидания времени. Обычно флаг уже стоит — тогда ничего
+        # не сохраняем; сбрасывается он только при резервном вызове (asked_for_time без time)
+        if not user_state.waiting_for_time:
+            user_state.waiting_for_time = True
+            save_user_state(chat_id, user_state)
         return
     
     # Используем общую функцию для применения времени
-    from datetime import datetime
-    now_utc = datetime.utcnow()
+    now_utc = datetime.now(timezone.utc)
     
     success = await apply_user_time(update, context, user_state, text, now_utc)
     
@@ -486,9 +537,11 @@ async def handle_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE,
             chat_id=chat_id,
             text="❌ Неверный формат времени. Введи, пожалуйста, в формате HH:MM, например 09:30.",
         )
-        # Убеждаемся, что остаемся в режиме ожидания времени
-        user_state.waiting_for_time = True
-        save_user_state(chat_id, user_state)
+        # Остаемся в режиме ожидания времени. Обычно флаг уже стоит — тогда ничего
+        # не сохраняем; сбрасывается он только при резервном вызове (asked_for_time без time)
+        if not user_state.waiting_for_time:
+            user_state.waiting_for_time = True
+            save_user_state(chat_id, user_state)
         return
     
     # Перезагружаем состояние после apply_user_time (чеклист мог быть создан)
@@ -500,26 +553,22 @@ async def handle_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE,
     # Добавляем сообщение с временем в список служебных
     user_state.service_message_ids.append(business_msg.message_id)
     
-    # Отправляем подтверждение и сохраняем его ID
-    parsed = parse_time_string(text)
-    confirm_msg = await context.bot.send_message(
-        business_connection_id=user_state.business_connection_id,
-        chat_id=chat_id,
-        text=f"✅ Время установлено: {parsed}",
+    # Отправляем подтверждение и одновременно удаляем все служебные сообщения (включая интро)
+    bconn = user_state.business_connection_id
+    confirm_msg, *_ = await asyncio.gather(
+        context.bot.send_message(
+            business_connection_id=bconn,
+            chat_id=chat_id,
+            text=f"✅ Время установлено: {user_state.day_end_time}",
+        ),
+        safe_delete_many(context.bot, bconn, chat_id, user_state.service_message_ids),
+        return_exceptions=True,
     )
-    user_state.service_message_ids.append(confirm_msg.message_id)
-    
-    # Удаляем все служебные сообщения (включая интро)
-    for mid in user_state.service_message_ids:
-        try:
-            await safe_delete(
-                context.bot,
-                user_state.business_connection_id,
-                chat_id,
-                mid,
-            )
-        except Exception as e:
-            logger.warning(f"⚠️ Не удалось удалить служебное сообщение {mid}: {e}")
+    if isinstance(confirm_msg, Exception):
+        logger.error(f"❌ Ошибка при отправке подтверждения времени для chat_id={chat_id}: {confirm_msg}", exc_info=confirm_msg)
+    else:
+        # Подтверждение тоже служебное — удаляем его следом
+        await safe_delete(context.bot, bconn, chat_id, confirm_msg.message_id)
     user_state.service_message_ids.clear()
     save_user_state(chat_id, user_state)
 
@@ -529,6 +578,28 @@ async def handle_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE,
 # ===============================
 # Обработчики callback-запросов (кнопки)
 # ===============================
+async def _handle_task_delete_callback(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    user_state: UserState,
+    chat_id: int,
+) -> None:
+    """Кнопка "Удалить": приводит cancel_pending_task к общей сигнатуре обработчиков кнопок"""
+    await cancel_pending_task(context.bot, chat_id, user_state, update, context)
+
+
+# Диспетчер кнопок: callback_data → обработчик (update, context, user_state, chat_id).
+# Кнопки выбора тега (TAG_SELECT:<тег>) обрабатываются отдельно — по префиксу
+_CALLBACK_DISPATCH = {
+    "TASK_SKIP": handle_task_skip_callback,
+    "TASK_TAG": handle_task_tag_callback,
+    "TASK_DELETE": _handle_task_delete_callback,
+    "TAGS_PAGE_NEXT": on_tags_page_next,
+    "TAGS_PAGE_PREV": on_tags_page_prev,
+}
+_TAG_SELECT_PREFIX = "TAG_SELECT:"
+
+
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик всех callback queries"""
     query = update.callback_query
@@ -549,19 +620,12 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         logger.warning(f"⚠️ handle_callback_query: user_state не найден для chat_id={chat_id}")
         return
     
-    if callback_data == "TASK_SKIP":
-        await handle_task_skip_callback(update, context, user_state, chat_id)
-    elif callback_data == "TASK_TAG":
-        await handle_task_tag_callback(update, context, user_state, chat_id)
-    elif callback_data == "TASK_DELETE":
-        await cancel_pending_task(context.bot, chat_id, user_state, update, context)
-    elif callback_data.startswith("TAG_SELECT:"):
-        tag = callback_data.replace("TAG_SELECT:", "")
+    handler = _CALLBACK_DISPATCH.get(callback_data)
+    if handler is not None:
+        await handler(update, context, user_state, chat_id)
+    elif callback_data.startswith(_TAG_SELECT_PREFIX):
+        tag = callback_data[len(_TAG_SELECT_PREFIX):]
         await handle_tag_select_callback(update, context, user_state, chat_id, tag)
-    elif callback_data == "TAGS_PAGE_NEXT":
-        await on_tags_page_next(update, context, user_state, chat_id)
-    elif callback_data == "TAGS_PAGE_PREV":
-        await on_tags_page_prev(update, context, user_state, chat_id)
 
 
 
@@ -572,7 +636,13 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
 def backup_state_db():
     """
     Создает резервную копию файла базы данных перед запуском бота.
-    Если файл БД существует, создается копия с timestamp в имени.
+    Если файл БД существует, создается копия с timestamp в имени;
+    хранятся только последние BACKUP_KEEP копий.
+
+    Копия делается через онлайн-бэкап SQLite (Connection.backup), а не копированием
+    файла: в режиме WAL часть изменений может лежать в state.db-wal, и копия одного
+    основного файла оказалась бы неполной. Backup API берёт согласованный снимок
+    и не мешает параллельным читателям и писателям.
     """
     db_path = DB_PATH
     
@@ -581,14 +651,33 @@ def backup_state_db():
         return
     
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        timestamp = strftime("%Y%m%d_%H%M%S")
         backup_filename = f"state_backup_{timestamp}.db"
         backup_path = db_path.parent / backup_filename
         
-        shutil.copy(db_path, backup_path)
+        src = sqlite3.connect(db_path)
+        try:
+            dst = sqlite3.connect(backup_path)
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+        finally:
+            src.close()
         logger.info(f"Создан резервный бэкап состояния: {backup_filename}")
     except Exception as e:
         logger.error(f"Не удалось создать бэкап state.db: {e}")
+        return
+    
+    # Удаляем старые бэкапы (имена с timestamp сортируются по времени)
+    old_backups = sorted(db_path.parent.glob("state_backup_*.db"))[:-BACKUP_KEEP]
+    for old_backup in old_backups:
+        try:
+            old_backup.unlink()
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось удалить старый бэкап {old_backup.name}: {e}")
+    if old_backups:
+        logger.info(f"🧹 Удалено старых бэкапов состояния: {len(old_backups)}")
 
 
 # ===============================
@@ -601,162 +690,225 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.info("Команда /start получена")
 
 
-async def handle_all_updates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик всех обновлений"""
-    print("UPDATE RECEIVED:", update.to_dict().keys())
-    
-    # Диагностическое логирование входящих обновлений (без больших JSON)
-    update_type = []
-    chat_id_info = "N/A"
-    
-    if update.business_message:
-        update_type.append("business_message")
-        chat_id_info = f"business_chat={update.business_message.chat.id}"
-    if update.message:
-        update_type.append("message")
-        chat_id_info = f"chat={update.message.chat.id}"
-    if update.callback_query:
-        update_type.append("callback_query")
-        if update.callback_query.message:
-            chat_id_info = f"callback_chat={update.callback_query.message.chat.id}"
-    
-    logger.info(f"DEBUG: 📥 Входящее обновление: тип={', '.join(update_type) or 'unknown'}, {chat_id_info}, update_id={update.update_id}")
-    
-    # Логирование всех обновлений для отладки
-    logger.info(f"📥 Получено обновление: business_message={bool(update.business_message)}, message={bool(update.message)}, callback_query={bool(update.callback_query)}")
-    
-    # Если это обычное сообщение (не business), просто логируем
-    if update.message and not update.business_message:
-        logger.info(f"ℹ️ Получено обычное сообщение (не business_message): chat_id={update.message.chat.id}, text={update.message.text}")
-        return
-    
-    # Обработка business_message
-    if update.business_message:
-        try:
-            business_msg = update.business_message
-            chat_id = business_msg.chat.id
-            logger.info(f"✅ business_message получено: chat_id={chat_id}, message_id={business_msg.message_id}, text={bool(business_msg.text)}, caption={bool(business_msg.caption)}")
-            
-            # 0. Если это событие изменения чеклиста (галочка/снятие) — обрабатываем и выходим
-            # Проверяем наличие полей, указывающих на событие изменения чеклиста
-            # ВАЖНО: проверяем ДО фильтрации системных сообщений!
-            is_checklist_state_event = (
-                (hasattr(business_msg, "new_checklist_item_state") and business_msg.new_checklist_item_state is not None)
-                or (hasattr(business_msg, "checklist_item_state") and business_msg.checklist_item_state is not None)
-                or (hasattr(business_msg, "new_checklist_item") and business_msg.new_checklist_item is not None)
-                or (hasattr(business_msg, "checklist_tasks_done") and business_msg.checklist_tasks_done is not None)
+# Диспетчер команд бизнес-чата: группа из _CMD_RE (в нижнем регистре) → обработчик
+_CMD_DISPATCH = {
+    "force_close": handle_force_close,
+    "force_newday": handle_force_newday,
+    "время": handle_time_command,
+    "time": handle_time_command,
+}
+
+
+async def handle_business_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обработчик business_message. Регистрируется с filters.UpdateType.BUSINESS_MESSAGE,
+    поэтому остальные обновления (обычные сообщения, кнопки) сюда не попадают.
+    """
+    try:
+        business_msg = update.business_message
+        chat_id = business_msg.chat.id
+        logger.info(
+            "✅ business_message получено: chat_id=%s, message_id=%s, text=%s, caption=%s",
+            chat_id, business_msg.message_id, bool(business_msg.text), bool(business_msg.caption),
+        )
+        
+        # 0. Если это событие изменения чеклиста (галочка/снятие) — обрабатываем и выходим
+        # Проверяем наличие полей, указывающих на событие изменения чеклиста
+        # ВАЖНО: проверяем ДО фильтрации системных сообщений!
+        is_checklist_state_event = any(
+            getattr(business_msg, attr, None) is not None for attr in _CHECKLIST_ATTRS
+        )
+        
+        if is_checklist_state_event:
+            logger.info("📋 Обнаружено событие изменения состояния чеклиста для chat_id=%s", chat_id)
+            user_state = load_user_state(chat_id)
+            if user_state:
+                await handle_checklist_state_update(business_msg, user_state, chat_id)
+            # После обработки события чеклиста выходим - не превращаем его в задачу
+            return
+        
+        # Получаем или создаём состояние пользователя (нужно для проверки команды)
+        user_state = get_or_create_user_state(update)
+        if not user_state:
+            logger.error("❌ Не удалось получить user_state для chat_id=%s", chat_id)
+            return
+        
+        # Команды /force_close, /force_newday, /время - обрабатываем вручную для business_message
+        # (CommandHandler не работает с business_message), ДО фильтра системных сообщений
+        text = business_msg.text or ""
+        cmd_match = _CMD_RE.match(text)
+        if cmd_match:
+            command = cmd_match.group(1).lower()
+            logger.info("✅ Команда /%s обнаружена для chat_id=%s, text='%s'", command, chat_id, text)
+            await _CMD_DISPATCH[command](update, context, user_state)
+            return
+        
+        # Отбрасываем системные / служебные бизнес-сообщения (в т.ч. чеклист-нотификации)
+        if is_system_or_service_business_message(business_msg):
+            logger.info("ℹ️ Сообщение отфильтровано как системное: chat_id=%s, message_id=%s", chat_id, business_msg.message_id)
+            return
+        
+        # Логирование для отладки
+        if (business_msg.audio or business_msg.voice) and logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "🎵 Аудио/голосовое сообщение: audio=%s, voice=%s, text=%s, caption=%s",
+                bool(business_msg.audio), bool(business_msg.voice), bool(business_msg.text), bool(business_msg.caption),
             )
-            
-            if is_checklist_state_event:
-                logger.info(f"📋 Обнаружено событие изменения состояния чеклиста для chat_id={chat_id}")
-                user_state = load_user_state(chat_id)
-                if user_state:
-                    await handle_checklist_state_update(business_msg, user_state, chat_id)
-                # После обработки события чеклиста выходим - не превращаем его в задачу
-                return
-            
-            # Получаем или создаём состояние пользователя (нужно для проверки команды)
-            user_state = get_or_create_user_state(update)
-            if not user_state:
-                logger.error(f"❌ Не удалось получить user_state для chat_id={chat_id}")
-                return
-            
-            # Команды /force_close и /force_newday - обрабатываем вручную для business_message
-            # (CommandHandler не работает с business_message)
-            text = (business_msg.text or "").strip()
-            if text.startswith("/force_close"):
-                await handle_force_close(update, context)
-                return
-            
-            if text.startswith("/force_newday"):
-                await handle_force_newday(update, context)
-                return
-
-            # Команда /время (смена времени чек-листа) - проверяем ДО фильтра системных сообщений
-            if text:
-                # Проверяем команду в разных форматах (регистронезависимо)
-                text_lower = text.lower()
-                is_time_command = (
-                    text_lower.startswith("/время") or 
-                    text_lower.startswith("/time") or
-                    (text.startswith("@") and ("/время" in text_lower or "/time" in text_lower))
-                )
-                
-                if is_time_command:
-                    logger.info(f"✅ Команда /время обнаружена для chat_id={chat_id}, text='{text}'")
-                    await handle_time_command(update, context, user_state)
-                    return
-            
-            # Отбрасываем системные / служебные бизнес-сообщения (в т.ч. чеклист-нотификации)
-            if is_system_or_service_business_message(business_msg):
-                logger.info(f"ℹ️ Сообщение отфильтровано как системное: chat_id={chat_id}, message_id={business_msg.message_id}")
-                return
-            
-            # Логирование для отладки
-            has_audio = bool(getattr(business_msg, "audio", None))
-            has_voice = bool(getattr(business_msg, "voice", None))
-            has_text = bool(getattr(business_msg, "text", None))
-            has_caption = bool(getattr(business_msg, "caption", None))
-            if has_audio or has_voice:
-                logger.info(f"🎵 Аудио/голосовое сообщение: audio={has_audio}, voice={has_voice}, text={has_text}, caption={has_caption}")
-            
-            # ЧЁТКИЙ ПОРЯДОК ПРОВЕРОК:
-            # 0) Проверяем и обновляем дату чеклиста, если она устарела
-            if user_state.checklist_message_id is not None:
-                current_user_date = get_user_local_date(user_state)
-                if user_state.date != current_user_date:
-                    logger.info(f"🔄 Дата устарела для chat_id={chat_id}: {user_state.date} → {current_user_date}, обновляю чеклист")
-                    user_state.date = current_user_date
-                    save_user_state(chat_id, user_state)
-                    await create_checklist_for_user(context.bot, chat_id, user_state)
-            
-            # 1) Ждём ввод времени (waiting_for_time) → обрабатываем как ввод времени
-            if user_state.waiting_for_time:
-                await handle_time_input(update, context, user_state)
-                return
-            
-            # 2) Ещё не просили время → интро + запрос
-            if not user_state.asked_for_time:
-                await handle_first_message(update, context, user_state)
-                return
-            
-            # 3) Уже просили время, но оно ещё НЕ установлено → парсим HH:MM (резервная проверка)
-            if user_state.asked_for_time and user_state.time is None:
-                await handle_time_input(update, context, user_state)
-                return
-            
-            # 3) Ждём тег (awaiting_tag) → обрабатываем как ввод тега
-            if user_state.awaiting_tag and user_state.pending_task_text:
-                await handle_tag_input(update, context, user_state)
-                return
-            
-            # 4) Время установлено (time is not None) → обрабатываем сообщение как задачу
-            await handle_task_addition(update, context, user_state)
+        
+        # ЧЁТКИЙ ПОРЯДОК ПРОВЕРОК:
+        # 0) Проверяем и обновляем дату чеклиста, если она устарела
+        if user_state.checklist_message_id is not None:
+            now_utc = datetime.now(timezone.utc)
+            current_user_date = get_user_local_date(user_state, now_utc)
+            if user_state.date != current_user_date:
+                logger.info("🔄 Дата устарела для chat_id=%s: %s → %s, обновляю чеклист", chat_id, user_state.date, current_user_date)
+                user_state.date = current_user_date
+                save_user_state(chat_id, user_state)
+                await create_checklist_for_user(context.bot, chat_id, user_state, now_utc)
+        
+        # 1) Ждём ввод времени (waiting_for_time) → обрабатываем как ввод времени
+        if user_state.waiting_for_time:
+            await handle_time_input(update, context, user_state)
             return
-        except Exception as e:
-            logger.error(f"❌ Ошибка в handle_all_updates при обработке business_message: {e}", exc_info=True)
+        
+        # 2) Ещё не просили время → интро + запрос
+        if not user_state.asked_for_time:
+            await handle_first_message(update, context, user_state)
+            return
+        
+        # 3) Уже просили время, но оно ещё НЕ установлено → парсим HH:MM (резервная проверка)
+        if user_state.asked_for_time and user_state.time is None:
+            await handle_time_input(update, context, user_state)
             return
+        
+        # 3) Ждём тег (awaiting_tag) → обрабатываем как ввод тега
+        if user_state.awaiting_tag and user_state.pending_task_text:
+            await handle_tag_input(update, context, user_state)
+            return
+        
+        # 4) Время установлено (time is not None) → обрабатываем сообщение как задачу
+        await handle_task_addition(update, context, user_state)
+        return
+    except Exception as e:
+        logger.error("❌ Ошибка в handle_business_message: %s", e, exc_info=True)
+        return
 
 
 # ===============================
 # Ежедневные задачи (закрытие дня и создание нового)
 # ===============================
-async def check_day_rollover(context: CallbackContext) -> None:
+async def _rollover_one(bot, chat_id: int, user_state: UserState, now_local: datetime) -> bool:
     """
-    Фоновая задача, которая проверяет всех пользователей и закрывает/открывает день
-    по их локальному времени.
+    Проверяет одного пользователя и при необходимости закрывает день и открывает новый.
     
-    Вызывается каждые 60 секунд через JobQueue.run_repeating().
+    now_local — текущее локальное время пользователя (utc_now + timezone_offset_minutes),
+    вычисленное вызывающим кодом.
     
-    Логика для каждого пользователя:
-    - Вычисляет локальное время: now_local = utc_now + timedelta(minutes=utc_offset_minutes)
+    Логика:
     - Проверяет условия закрытия дня:
-      - utc_offset_minutes и day_end_time установлены
+      - day_end_time установлено
       - local_date > last_closed_date ИЛИ (local_date == last_closed_date и local_time >= day_end_time)
     - Если условия выполнены: закрывает день и создает новый
+    
+    Возвращает False, если смену дня нужно повторить (ошибка или день не закрылся).
+    """
+    try:
+        # Проверяем, что day_end_time установлено
+        if not user_state.day_end_time:
+            return True
+        
+        local_date = now_local.date().isoformat()
+        local_time = now_local.time()
+        
+        # Парсим day_end_time из "HH:MM"
+        parts = parse_time_parts(user_state.day_end_time)
+        if parts is None:
+            logger.warning("⚠️ Неверный формат day_end_time для chat_id=%s: %s", chat_id, user_state.day_end_time)
+            return True
+        day_end_time_obj = time(*parts)
+        
+        # Проверяем условия для закрытия дня
+        should_close = False
+        
+        if user_state.last_closed_date:
+            # Условие: local_date > last_closed_date ИЛИ (local_date == last_closed_date и local_time >= day_end_time)
+            if local_date > user_state.last_closed_date:
+                should_close = True
+                logger.info("AUTO_DAY_CLOSE chat_id=%s local_date=%s (дата сменилась: %s → %s)", chat_id, local_date, user_state.last_closed_date, local_date)
+            elif local_date == user_state.last_closed_date and local_time >= day_end_time_obj:
+                should_close = True
+                logger.info("AUTO_DAY_CLOSE chat_id=%s local_date=%s (время достигло day_end_time: %s >= %s)", chat_id, local_date, local_time, day_end_time_obj)
+        else:
+            # last_closed_date не установлено - проверяем только время
+            if local_time >= day_end_time_obj:
+                should_close = True
+                logger.info("AUTO_DAY_CLOSE chat_id=%s local_date=%s (первое закрытие, время достигло day_end_time: %s >= %s)", chat_id, local_date, local_time, day_end_time_obj)
+        
+        if should_close:
+            # ЗАЩИТА ОТ ДВОЙНОГО ЗАКРЫТИЯ: проверяем, не закрыли ли уже день
+            # Если last_closed_date уже равен local_date, значит день уже закрыт
+            if user_state.last_closed_date == local_date:
+                logger.debug("⏭️ День уже закрыт для chat_id=%s, last_closed_date=%s, local_date=%s", chat_id, user_state.last_closed_date, local_date)
+                return True
+            
+            # Закрываем день (сохраняет дату, которую закрываем, в last_closed_date;
+            # возвращает обновлённое состояние — перечитывать не нужно)
+            user_state = await close_day_for_user(bot, chat_id, user_state)
+            
+            # Проверяем, что день действительно закрыт (защита от повторного закрытия)
+            if user_state.last_closed_date == local_date:
+                # Открываем новый день (обновляет user_state.date на новую дату)
+                user_state = await start_new_day_for_user(bot, chat_id, user_state)
+                logger.info("AUTO_NEW_DAY chat_id=%s local_date=%s", chat_id, user_state.date)
+            else:
+                logger.warning("⚠️ День не был закрыт для chat_id=%s, last_closed_date=%s, ожидалось=%s", chat_id, user_state.last_closed_date, local_date)
+                return False
+        return True
+    
+    except (TelegramError, sqlite3.Error) as e:
+        # Ожидаемые сбои (лимиты/сеть Telegram, занятая БД) при массовой смене дня бывают
+        # пачками — пишем без трейсбека; следующая проверка повторит попытку
+        logger.error("ERROR_DAY_ROLLOVER chat_id=%s error=%r", chat_id, e)
+    except Exception as e:
+        logger.error("ERROR_DAY_ROLLOVER chat_id=%s error=%s", chat_id, e, exc_info=True)
+    return False
+
+
+async def _rollover_bounded(sem: asyncio.Semaphore, bot, chat_id: int, user_state: UserState, now_local: datetime) -> Tuple[int, bool]:
+    """Выполняет _rollover_one, удерживая слот семафора; возвращает chat_id и успех"""
+    async with sem:
+        ok = await _rollover_one(bot, chat_id, user_state, now_local)
+    return chat_id, ok
+
+
+async def checkpoint_wal_job(context: CallbackContext) -> None:
+    """Периодический checkpoint WAL (выполняется в потоке, чтобы не блокировать event loop)"""
+    try:
+        busy, log_pages, checkpointed = await asyncio.to_thread(checkpoint_wal)
+        if busy:
+            logger.debug("WAL checkpoint не завершён (БД занята): страниц в WAL=%s, перенесено=%s", log_pages, checkpointed)
+    except Exception as e:
+        logger.warning("⚠️ Ошибка при checkpoint WAL: %s", e)
+
+
+async def check_day_rollover(context: CallbackContext) -> None:
     """
+    Фоновая задача, которая проверяет всех пользователей и закрывает/открывает день
+    по их локальному времени.
+    
+    Страховка для индивидуальных midnight job'ов. После каждого запуска
+    перепланирует себя через schedule_rollover_check() — к ближайшему моменту
+    смены дня, а не через фиксированный интервал; если у кого-то смена дня
+    не удалась — через ROLLOVER_RETRY_DELAY.
+    
+    Пользователи обрабатываются параллельно (_rollover_one), но не более
+    ROLLOVER_CONCURRENCY одновременно (по умолчанию 20) — чтобы не упереться
+    в лимиты Telegram API.
+    """
+    # Есть ли пользователи, у которых смена дня не удалась и ещё должна произойти
+    retry = False
     try:
-        logger.debug(f"🔄 [check_day_rollover] Запуск проверки смены дня для всех пользователей")
+        logger.debug("🔄 [check_day_rollover] Запуск проверки смены дня для всех пользователей")
         
         # Получаем bot из context
         bot = getattr(context, 'bot', None)
@@ -767,93 +919,100 @@ async def check_day_rollover(context: CallbackContext) -> None:
             logger.error("❌ Не удалось получить bot из context в check_day_rollover")
             return
         
-        from db import get_all_chat_ids
-        from state import load_user_state, save_user_state
-        from helpers_daily import close_day_for_user, start_new_day_for_user
-        from datetime import datetime, timedelta, time
+        utc_now = datetime.now(timezone.utc)
+        
+        # Загружаем одним запросом только кандидатов — пользователей, у которых
+        # уже наступил next_close_utc (момент ближайшей возможной смены дня)
+        utc_ts = int(utc_now.timestamp())
+        user_states = load_rollover_candidates(utc_ts)
+        if not user_states:
+            return
         
-        # Загружаем всех пользователей из базы данных
-        chat_ids = get_all_chat_ids()
+        sem = asyncio.Semaphore(get_config().rollover_concurrency)
         
-        utc_now = datetime.utcnow()
+        # Локальное время считаем один раз на каждое смещение
+        # (различных часовых поясов обычно единицы, пользователей — намного больше)
+        now_local_by_offset: Dict[int, datetime] = {}
+        tasks = []
+        for chat_id, user_state in user_states.items():
+            # Быстрая проверка по закэшированному состоянию (оно может быть новее строки в БД):
+            # до next_close_utc смена дня заведомо не нужна — без разбора времени и дат
+            if user_state.next_close_utc is not None and utc_ts < user_state.next_close_utc:
+                continue
+            offset_minutes = user_state.timezone_offset_minutes or 0
+            now_local = now_local_by_offset.get(offset_minutes)
+            if now_local is None:
+                now_local = now_local_by_offset[offset_minutes] = utc_now + timedelta(minutes=offset_minutes)
+            tasks.append(asyncio.create_task(_rollover_bounded(sem, bot, chat_id, user_state, now_local)))
         
-        for chat_id in chat_ids:
+        # Закрытие и открытие дня идут в одной корутине на пользователя, поэтому новый
+        # чеклист отправляется сразу после закрытия его дня; результаты разбираем
+        # по мере готовности, не дожидаясь всей пачки
+        for next_done in asyncio.as_completed(tasks):
             try:
-                # Загружаем состояние из базы
-                user_state = load_user_state(chat_id)
-                if not user_state:
-                    continue
-                
-                # Проверяем, что utc_offset_minutes и day_end_time установлены
-                utc_offset_minutes = getattr(user_state, "timezone_offset_minutes", 0) or 0
-                if not user_state.day_end_time or utc_offset_minutes == 0 and user_state.day_end_time is None:
-                    continue
-                
-                # Вычисляем локальное время пользователя
-                now_local = utc_now + timedelta(minutes=utc_offset_minutes)
-                local_date = now_local.date().isoformat()
-                local_time = now_local.time()
-                
-                # Парсим day_end_time из "HH:MM"
-                try:
-                    h, m = map(int, user_state.day_end_time.split(":"))
-                    day_end_time_obj = time(h, m)
-                except Exception:
-                    logger.warning(f"⚠️ Неверный формат day_end_time для chat_id={chat_id}: {user_state.day_end_time}")
-                    continue
-                
-                # Проверяем условия для закрытия дня
-                should_close = False
-                
-                if user_state.last_closed_date:
-                    # Условие: local_date > last_closed_date ИЛИ (local_date == last_closed_date и local_time >= day_end_time)
-                    if local_date > user_state.last_closed_date:
-                        should_close = True
-                        logger.info(f"AUTO_DAY_CLOSE chat_id={chat_id} local_date={local_date} (дата сменилась: {user_state.last_closed_date} → {local_date})")
-                    elif local_date == user_state.last_closed_date and local_time >= day_end_time_obj:
-                        should_close = True
-                        logger.info(f"AUTO_DAY_CLOSE chat_id={chat_id} local_date={local_date} (время достигло day_end_time: {local_time} >= {day_end_time_obj})")
+                chat_id, ok = await next_done
+                if ok:
+                    logger.debug("✅ [check_day_rollover] Обработан chat_id=%s", chat_id)
                 else:
-                    # last_closed_date не установлено - проверяем только время
-                    if local_time >= day_end_time_obj:
-                        should_close = True
-                        logger.info(f"AUTO_DAY_CLOSE chat_id={chat_id} local_date={local_date} (первое закрытие, время достигло day_end_time: {local_time} >= {day_end_time_obj})")
-                
-                if should_close:
-                    # ЗАЩИТА ОТ ДВОЙНОГО ЗАКРЫТИЯ: проверяем, не закрыли ли уже день
-                    # Если last_closed_date уже равен local_date, значит день уже закрыт
-                    if user_state.last_closed_date == local_date:
-                        logger.debug(f"⏭️ День уже закрыт для chat_id={chat_id}, last_closed_date={user_state.last_closed_date}, local_date={local_date}")
-                        continue
-                    
-                    # Закрываем день (сохраняет дату, которую закрываем, в last_closed_date)
-                    await close_day_for_user(bot, chat_id, user_state)
-                    
-                    # Перезагружаем состояние после закрытия
-                    user_state = load_user_state(chat_id)
-                    if not user_state:
-                        logger.error(f"❌ Не удалось загрузить user_state после close_day_for_user для chat_id={chat_id}")
-                        continue
-                    
-                    # Проверяем, что день действительно закрыт (защита от повторного закрытия)
-                    if user_state.last_closed_date == local_date:
-                        # Открываем новый день (обновляет user_state.date на новую дату)
-                        await start_new_day_for_user(bot, chat_id, user_state)
-                        
-                        # Перезагружаем состояние после открытия нового дня
-                        user_state = load_user_state(chat_id)
-                        if user_state:
-                            logger.info(f"AUTO_NEW_DAY chat_id={chat_id} local_date={user_state.date}")
-                        else:
-                            logger.error(f"❌ Не удалось загрузить user_state после start_new_day_for_user для chat_id={chat_id}")
-                    else:
-                        logger.warning(f"⚠️ День не был закрыт для chat_id={chat_id}, last_closed_date={user_state.last_closed_date}, ожидалось={local_date}")
-                    
+                    retry = True
             except Exception as e:
-                logger.error(f"ERROR_DAY_ROLLOVER chat_id={chat_id} error={e}", exc_info=True)
-                # Продолжаем обработку остальных пользователей
+                retry = True
+                logger.error("ERROR_DAY_ROLLOVER error=%s", e, exc_info=True)
     except Exception as e:
-        logger.error(f"❌ Критическая ошибка в check_day_rollover: {e}", exc_info=True)
+        retry = True
+        logger.error("❌ Критическая ошибка в check_day_rollover: %s", e, exc_info=True)
+    finally:
+        if context.job_queue:
+            schedule_rollover_check(context.job_queue, retry=retry)
+
+
+def schedule_rollover_check(job_queue, retry: bool = False) -> None:
+    """
+    Ставит следующий запуск check_day_rollover: через ROLLOVER_GRACE после ближайшего
+    next_close_utc, но не позже чем через ROLLOVER_MAX_DELAY (на случай, если время
+    сменилось у пользователя, не дошедшего до БД, или ближайший момент неизвестен).
+    retry=True — смена дня у кого-то не удалась: next_rollover_after таких пользователей
+    не видит (их next_close_utc уже прошёл), поэтому повторяем не позже чем через
+    ROLLOVER_RETRY_DELAY.
+    """
+    try:
+        utc_ts = int(datetime.now(timezone.utc).timestamp())
+        next_close_utc = next_rollover_after(utc_ts)
+        delay = ROLLOVER_MAX_DELAY
+        if next_close_utc is not None:
+            delay = min(next_close_utc - utc_ts + ROLLOVER_GRACE, ROLLOVER_MAX_DELAY)
+        if retry:
+            delay = min(delay, ROLLOVER_RETRY_DELAY)
+        
+        job_queue.run_once(check_day_rollover, when=delay, name=ROLLOVER_JOB_NAME)
+        logger.debug("⏰ Следующая проверка смены дня через %s секунд", delay)
+    except Exception as e:
+        logger.error(f"❌ Ошибка при планировании check_day_rollover: {e}", exc_info=True)
+
+
+# Восстановлены ли midnight job'ы в этом процессе (повторный post_init их не дублирует)
+_jobs_restored = False
+
+
+def _ensure_jobs_scheduled(job_queue) -> None:
+    """
+    Восстанавливает индивидуальные midnight job'ы всех пользователей с установленным
+    временем. Выполняется один раз за процесс; состояния загружаются одним запросом.
+    """
+    global _jobs_restored
+    if _jobs_restored:
+        return
+    try:
+        # Одним запросом и только пользователи с установленным временем (остальным job не нужен)
+        to_restore = load_scheduled_user_states()
+        # Один момент "сейчас" на всех; старых midnight job'ов в новом процессе нет — не ищем их
+        now_utc = datetime.now(timezone.utc)
+        for chat_id, user_state in to_restore.items():
+            schedule_user_midnight_job(job_queue, chat_id, user_state, now_utc, replace_existing=False)
+        _jobs_restored = True
+        logger.info(f"✅ Восстановлено {len(to_restore)} индивидуальных midnight job'ов для существующих пользователей")
+    except Exception as e:
+        logger.error(f"❌ Ошибка при восстановлении midnight job'ов: {e}", exc_info=True)
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -870,244 +1029,178 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         logger.warning(f"⚠️ Неожиданная ошибка: {err}")
 
 
+def start_backup_thread() -> threading.Thread:
+    """
+    Запускает backup_state_db в фоновом потоке, чтобы копирование файла БД
+    шло параллельно с остальной подготовкой к запуску.
+    """
+    backup_thread = threading.Thread(target=backup_state_db, name="state-backup", daemon=True)
+    backup_thread.start()
+    return backup_thread
+
+
+def install_uvloop() -> bool:
+    """
+    Ставит uvloop политикой event loop'а (до создания приложения — run_polling
+    берёт loop из текущей политики). Без uvloop (Windows, dev-окружение) остаётся
+    стандартный asyncio. Возвращает True, если uvloop подключён.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        logger.debug("uvloop не установлен — используется стандартный event loop asyncio")
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("✅ Event loop: uvloop %s", uvloop.__version__)
+    return True
+
+
 def main():
     """Запуск бота"""
-    print("=" * 60)
-    print("DEBUG: Начало запуска бота")
-    print("=" * 60)
+    logger.debug("Начало запуска бота")
     
-    # Резервирование базы данных перед запуском
-    backup_state_db()
+    install_uvloop()
     
-    # Инициализация базы данных
-    try:
-        init_db()
-        print("DEBUG: База данных инициализирована")
-        logger.info("✅ База данных инициализирована")
-    except Exception as e:
-        print(f"❌ ОШИБКА при инициализации БД: {e}")
-        logger.error(f"Ошибка при инициализации БД: {e}", exc_info=True)
-        return
+    # Резервирование базы данных перед запуском (в фоне, параллельно с проверками
+    # и сборкой приложения ниже; ждём его только перед init_db)
+    backup_thread = start_backup_thread()
     
     # Проверка зависимостей
     try:
         import telegram
-        print(f"DEBUG: python-telegram-bot версия: {telegram.__version__}")
+        logger.debug("python-telegram-bot версия: %s", telegram.__version__)
     except ImportError as e:
-        print(f"❌ ОШИБКА: python-telegram-bot не установлен: {e}")
-        print("Установите зависимости: pip install -r requirements.txt")
+        logger.error("❌ python-telegram-bot не установлен: %s\nУстановите зависимости: pip install -r requirements.txt", e)
         return
     
     try:
         import dotenv
-        print("DEBUG: python-dotenv установлен")
+        logger.debug("python-dotenv установлен")
     except ImportError as e:
-        print(f"❌ ОШИБКА: python-dotenv не установлен: {e}")
-        print("Установите зависимости: pip install -r requirements.txt")
+        logger.error("❌ python-dotenv не установлен: %s\nУстановите зависимости: pip install -r requirements.txt", e)
         return
     
-    # Загрузка токена из .env
-    env_path = Path(__file__).parent / ".env"
-    print(f"DEBUG: Проверка .env файла: {env_path}")
-    print(f"DEBUG: .env файл существует: {env_path.exists()}")
+    # Токен из .env (файлы уже прочитаны get_config при импорте)
+    config = get_config()
+    env_path = config.env_path
+    logger.debug("Проверка .env файла: %s", env_path)
     
     if not env_path.exists():
-        print("=" * 60)
-        print("❌ ОШИБКА: Файл .env не найден!")
-        print("=" * 60)
-        print("Создайте файл .env в корне проекта со следующим содержимым:")
-        print("")
-        print("BOT_TOKEN=your_bot_token_here")
-        print("")
-        print("Где your_bot_token_here - токен вашего бота от @BotFather")
-        print("=" * 60)
-        logger.error("Файл .env не найден в корне проекта")
+        logger.error(
+            "❌ Файл .env не найден: %s\n"
+            "Создайте его со строкой:\n"
+            "BOT_TOKEN=your_bot_token_here\n"
+            "Где your_bot_token_here - токен вашего бота от @BotFather",
+            env_path,
+        )
         return
     
-    # Перезагружаем .env для уверенности
-    load_dotenv(env_path)
+    BOT_TOKEN = config.bot_token
     
-    BOT_TOKEN = os.getenv("BOT_TOKEN")
-    
-    # Отладочный вывод токена (частично скрыт для безопасности)
+    # Сам токен не выводим — только факт загрузки
     if BOT_TOKEN:
-        token_preview = BOT_TOKEN[:10] + "..." + BOT_TOKEN[-5:] if len(BOT_TOKEN) > 15 else "***"
-        print(f"DEBUG: BOT_TOKEN загружен: {token_preview}")
-        logger.info(f"DEBUG: BOT_TOKEN загружен (длина: {len(BOT_TOKEN)} символов)")
+        logger.info("BOT_TOKEN загружен (длина: %d символов)", len(BOT_TOKEN))
     else:
-        print("=" * 60)
-        print("❌ ОШИБКА: BOT_TOKEN не найден в .env!")
-        print("=" * 60)
-        print("Убедитесь, что файл .env содержит строку:")
-        print("BOT_TOKEN=your_bot_token_here")
-        print("")
-        print("Где your_bot_token_here - токен вашего бота от @BotFather")
-        print("=" * 60)
-        logger.error("BOT_TOKEN не найден в .env")
+        logger.error(
+            "❌ BOT_TOKEN не найден в .env!\n"
+            "Убедитесь, что файл .env содержит строку:\n"
+            "BOT_TOKEN=your_bot_token_here\n"
+            "Где your_bot_token_here - токен вашего бота от @BotFather"
+        )
         return
     
-    print("DEBUG: BOT_TOKEN=", BOT_TOKEN)
-    
-    print("DEBUG: Создание приложения...")
-    
     try:
         # Создание приложения
-        app = ApplicationBuilder().token(BOT_TOKEN).build()
-        print("DEBUG: Приложение создано успешно")
+        builder = ApplicationBuilder().token(BOT_TOKEN)
+        # Общий лимитер исходящих запросов: всплески отправок/удалений от многих
+        # пользователей сглаживаются на стороне бота, а не через 429 от Telegram
+        try:
+            builder = builder.rate_limiter(AIORateLimiter(max_retries=RATE_LIMIT_MAX_RETRIES))
+        except RuntimeError as e:
+            # AIORateLimiter требует python-telegram-bot[rate-limiter]
+            logger.warning(f"⚠️ Лимитер запросов не подключён: {e}")
+        app = builder.build()
+        logger.debug("Приложение создано")
     except Exception as e:
-        print(f"❌ ОШИБКА при создании приложения: {e}")
         logger.error(f"Ошибка при создании приложения: {e}", exc_info=True)
         return
     
     # Добавление обработчиков
-    print("DEBUG: Добавление обработчиков...")
     app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("force_close", handle_force_close))
-    app.add_handler(CommandHandler("force_newday", handle_force_newday))
     app.add_handler(CallbackQueryHandler(handle_callback_query))
-    # Обработчик всех обновлений (должен быть последним, чтобы не перехватывать команды)
-    app.add_handler(TypeHandler(Update, handle_all_updates), group=-1)
+    # Сообщения бизнес-чатов: фильтр отсекает остальные обновления ещё до вызова обработчика
+    app.add_handler(MessageHandler(filters.UpdateType.BUSINESS_MESSAGE, handle_business_message))
     
     # Обработчик ошибок
     app.add_error_handler(error_handler)
     
-    print("DEBUG: Обработчики добавлены")
-    
-    # Настраиваем job_queue для периодической проверки смены дня
-    # В python-telegram-bot 22.x job_queue настраивается через обработчик первого обновления
-    job_queue_configured = False
-    
-    # Настраиваем job_queue через application.post_init (вызывается после инициализации)
+    # Настраиваем job_queue через application.post_init (вызывается после инициализации;
+    # PTB гарантирует, что job_queue к этому моменту уже создан)
     async def setup_jobs_post_init(app_instance):
         """Настраивает job_queue после инициализации приложения"""
+        # Фоновая пакетная запись состояний в SQLite (нужен работающий event loop)
+        start_state_writer()
+        
         try:
-            # Ждем немного, чтобы job_queue точно был готов
-            import asyncio
-            await asyncio.sleep(3)
-            
             if hasattr(app_instance, 'job_queue') and app_instance.job_queue:
                 job_queue = app_instance.job_queue
                 
                 # 1. Настраиваем резервный механизм проверки смены дня
+                # (первый запуск через минуту — подхватывает смены дня, пропущенные при простое)
+                job_queue.run_once(check_day_rollover, when=60, name=ROLLOVER_JOB_NAME)
+                logger.info("✅ Настроена резервная проверка конца дня (post_init): к ближайшей смене дня пользователей")
+                
                 job_queue.run_repeating(
-                    callback=check_day_rollover,
-                    interval=60,
-                    first=60,
+                    callback=checkpoint_wal_job,
+                    interval=WAL_CHECKPOINT_INTERVAL,
+                    first=WAL_CHECKPOINT_INTERVAL,
                 )
-                logger.info("✅ Настроена периодическая проверка конца дня (post_init): каждые 60 секунд")
                 
                 # 2. Восстанавливаем индивидуальные midnight job'ы для всех существующих пользователей
-                try:
-                    from helpers_daily import schedule_user_midnight_job
-                    chat_ids = get_all_chat_ids()
-                    restored_count = 0
-                    for chat_id in chat_ids:
-                        user_state = load_user_state(chat_id)
-                        if user_state and user_state.time:
-                            # Восстанавливаем job для пользователя с установленным временем
-                            schedule_user_midnight_job(job_queue, chat_id, user_state)
-                            restored_count += 1
-                    logger.info(f"✅ Восстановлено {restored_count} индивидуальных midnight job'ов для существующих пользователей")
-                except Exception as e:
-                    logger.error(f"❌ Ошибка при восстановлении midnight job'ов: {e}", exc_info=True)
-                
-                print("DEBUG: ✅ job_queue настроен для проверки смены дня (post_init)")
+                _ensure_jobs_scheduled(job_queue)
             else:
-                logger.warning("⚠️ job_queue отсутствует в post_init, будет настроен при первом обновлении")
+                logger.warning("⚠️ job_queue отсутствует в post_init — установите python-telegram-bot[job-queue]")
         except Exception as e:
             logger.error(f"❌ Ошибка при настройке job_queue в post_init: {e}", exc_info=True)
     
     app.post_init = setup_jobs_post_init
     
+    async def flush_state_on_shutdown(app_instance):
+        """Дописывает отложенные сохранения состояний перед остановкой"""
+        await stop_state_writer()
+        close_shared_connection()
+    
+    app.post_shutdown = flush_state_on_shutdown
+    
+    # Бэкап должен отражать состояние ДО миграций init_db
+    backup_thread.join()
+    
+    # Инициализация базы данных (до run_polling: post_init уже читает состояния)
+    try:
+        journal_mode = init_db()
+        if journal_mode.lower() == "wal":
+            logger.info(f"✅ База данных инициализирована (journal_mode={journal_mode})")
+        else:
+            # Например, БД на сетевой ФС: чтения и записи будут блокировать друг друга
+            logger.warning(f"⚠️ База данных инициализирована, но режим WAL не включился (journal_mode={journal_mode})")
+    except Exception as e:
+        logger.error(f"Ошибка при инициализации БД: {e}", exc_info=True)
+        return
+    
     logger.info(f"🚀 Запуск бота, версия {BOT_VERSION}")
     logger.info("🤖 Бот запускается...")
     logger.info(f"Ожидаю business_message с бизнес-аккаунта...")
     
-    print("=" * 60)
-    print("DEBUG: Запуск polling...")
-    print("=" * 60)
-    
-    print("DEBUG: BOT STARTED AND WAITING FOR UPDATES")
-    
     # Запуск бота с глобальной обработкой ошибок
     try:
-        # Настраиваем job_queue через обработчик первого обновления
-        async def setup_job_on_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            """Настраивает job_queue при первом обновлении"""
-            nonlocal job_queue_configured
-            if job_queue_configured:
-                return
-            
-            try:
-                # Получаем job_queue из application
-                if not hasattr(context, 'application') or not context.application:
-                    logger.warning("⚠️ context.application отсутствует")
-                    return
-                
-                job_queue = context.application.job_queue
-                if not job_queue:
-                    logger.warning("⚠️ job_queue отсутствует в application")
-                    return
-                
-                # 1. Настраиваем резервный механизм проверки смены дня
-                job_queue.run_repeating(
-                    callback=check_day_rollover,
-                    interval=60,
-                    first=60,
-                )
-                logger.info("✅ Настроена периодическая проверка конца дня (после первого обновления): каждые 60 секунд")
-                
-                # 2. Восстанавливаем индивидуальные midnight job'ы для всех существующих пользователей
-                try:
-                    from helpers_daily import schedule_user_midnight_job
-                    chat_ids = get_all_chat_ids()
-                    restored_count = 0
-                    for chat_id in chat_ids:
-                        user_state = load_user_state(chat_id)
-                        if user_state and user_state.time:
-                            # Восстанавливаем job для пользователя с установленным временем
-                            schedule_user_midnight_job(job_queue, chat_id, user_state)
-                            restored_count += 1
-                    logger.info(f"✅ Восстановлено {restored_count} индивидуальных midnight job'ов для существующих пользователей")
-                except Exception as e:
-                    logger.error(f"❌ Ошибка при восстановлении midnight job'ов: {e}", exc_info=True)
-                
-                print("DEBUG: ✅ job_queue настроен для проверки смены дня")
-                job_queue_configured = True
-                
-                # Удаляем этот обработчик после успешной настройки
-                try:
-                    # Удаляем обработчик через application
-                    handlers = context.application.handlers[0]
-                    for handler in handlers[:]:
-                        if hasattr(handler, 'callback') and handler.callback == setup_job_on_first_update:
-                            handlers.remove(handler)
-                            logger.info("✅ Обработчик setup_job_on_first_update удален")
-                except Exception as e:
-                    logger.warning(f"⚠️ Не удалось удалить обработчик: {e}")
-                    
-            except Exception as e:
-                logger.error(f"❌ Ошибка при настройке job_queue: {e}", exc_info=True)
-        
-        # Добавляем обработчик для настройки job_queue при первом обновлении
-        app.add_handler(TypeHandler(Update, setup_job_on_first_update), group=0)
-        
         app.run_polling(
             drop_pending_updates=True,
-            allowed_updates=["message", "business_message", "edited_business_message", "callback_query"]
+            allowed_updates=ALLOWED_UPDATES,
         )
     except KeyboardInterrupt:
-        print("\nDEBUG: Получен сигнал прерывания (Ctrl+C)")
         logger.info("Получен сигнал прерывания, остановка бота...")
     except Exception as e:
-        print("=" * 60)
-        print(f"❌ КРИТИЧЕСКАЯ ОШИБКА при запуске polling:")
-        print(f"Тип ошибки: {type(e).__name__}")
-        print(f"Сообщение: {e}")
-        print("=" * 60)
-        logger.error(f"Критическая ошибка при запуске polling: {e}", exc_info=True)
-        import traceback
-        traceback.print_exc()
+        logger.error(f"❌ Критическая ошибка при запуске polling ({type(e).__name__}): {e}", exc_info=True)
 
 
 if __name__ == "__main__":
@@ -3,29 +3,77 @@
 
 Содержит:
 - UserState: dataclass с полями состояния пользователя
-- STATE: глобальное хранилище состояний (in-memory кэш)
+- STATE: глобальное хранилище состояний (in-memory LRU-кэш)
 - load_user_state/save_user_state: функции для работы со состоянием (SQLite + кэш)
+- load_all_user_states/load_scheduled_user_states/load_rollover_candidates: пакетная загрузка состояний
+- start_state_writer/stop_state_writer: фоновая пакетная запись в SQLite
 """
 
+import asyncio
 import json
 import logging
 import sqlite3
+import sys
+import threading
+import weakref
+from collections import OrderedDict, deque
 from dataclasses import dataclass, field
-from typing import Optional, Dict, List
-from db import get_connection
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from operator import attrgetter
+from time import monotonic
+from typing import Deque, Optional, Dict, List, Tuple
+from db import shared_connection, delete_user_state as db_delete_user_state
 
 logger = logging.getLogger(__name__)
 
+# Сколько последних служебных сообщений хранить для удаления (более старые вытесняются)
+SERVICE_MESSAGE_IDS_LIMIT = 32
 
-@dataclass
+# Сколько последних тегов хранить в истории (свежие в начале, старые вытесняются с конца)
+TAGS_HISTORY_LIMIT = 30
+
+# JSON-колонки user_state кодируются orjson, если он установлен (в разы быстрее json);
+# без него — стандартный json. Формат в БД один и тот же: строка JSON в UTF-8
+try:
+    import orjson
+    
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+    
+    _json_loads = orjson.loads
+except ImportError:
+    # Один заранее созданный кодировщик (json.dumps с аргументами создаёт новый на каждый вызов)
+    # и компактные разделители — без пробелов после "," и ":"
+    _json_dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+    _json_loads = json.JSONDecoder().decode
+
+# Состояния тысяч чатов живут в кэше STATE: без __dict__ у каждого объекта они занимают
+# заметно меньше памяти. slots у dataclass есть с Python 3.10; на 3.9 классы обычные
+_DATACLASS_OPTIONS = {"slots": True} if sys.version_info >= (3, 10) else {}
+# UserState дополнительно нужен слот для weakref (см. _StateCache); weakref_slot есть с Python 3.11
+_USER_STATE_DATACLASS_OPTIONS = {"slots": True, "weakref_slot": True} if sys.version_info >= (3, 11) else {}
+
+
+@dataclass(**_DATACLASS_OPTIONS)
 class TaskItem:
     """Элемент задачи в чеклисте"""
     item_id: int      # id пункта в Telegram Checklist
     text: str         # текст задачи
     done: bool = False  # выполнена ли задача
+    # (text, нормализованный text) — кэш для norm(); пересчитывается, если text заменён
+    _norm: Optional[Tuple[str, str]] = field(default=None, init=False, repr=False, compare=False)
+    
+    def norm(self) -> str:
+        """Текст для сравнения дубликатов: без пробелов по краям, в нижнем регистре"""
+        cached = self._norm
+        if cached is None or cached[0] is not self.text:
+            cached = (self.text, self.text.strip().lower())
+            self._norm = cached
+        return cached[1]
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class TagChecklistState:
     """Состояние чеклиста по тегу"""
     title: str  # текст тега
@@ -33,7 +81,7 @@ class TagChecklistState:
     tasks: List[TaskItem] = field(default_factory=list)  # список задач
 
 
-@dataclass
+@dataclass(**_USER_STATE_DATACLASS_OPTIONS)
 class UserState:
     business_connection_id: str
     asked_for_time: bool = False   # показывали интро и просили время?
@@ -49,133 +97,175 @@ class UserState:
     last_closed_date: Optional[str] = None       # дата последнего закрытия дня (защита от двойного закрытия)
     last_opened_date: Optional[str] = None       # дата последнего открытия дня (защита от двойного закрытия)
     
-    # Служебные сообщения для удаления
-    service_message_ids: List[int] = field(default_factory=list)
+    # Служебные сообщения для удаления (ограниченная очередь — список не растёт бесконечно)
+    service_message_ids: Deque[int] = field(default_factory=lambda: deque(maxlen=SERVICE_MESSAGE_IDS_LIMIT))
     
     # Поля для подтверждения задачи и тегов:
     pending_task_text: Optional[str] = None  # текущая "висящая" задача
     pending_task_message_id: Optional[int] = None  # сообщение пользователя с задачей
     pending_service_message_ids: List[int] = field(default_factory=list)  # все служебные сообщения вокруг задачи
     awaiting_tag: bool = False  # сейчас ждём тег вместо новой задачи
-    tags_history: List[str] = field(default_factory=list)  # список последних используемых тегов
+    tags_history: Deque[str] = field(default_factory=lambda: deque(maxlen=TAGS_HISTORY_LIMIT))  # последние используемые теги (свежие в начале)
     tags_page_index: int = 0  # индекс страницы для листания тегов
     pending_confirm_job_id: Optional[str] = None  # id задачи в job_queue для авто-"Пропустить"
     next_rollover_job_name: Optional[str] = None  # имя job'а для смены дня (индивидуальный midnight job)
+    next_close_utc: Optional[int] = None  # unix-время UTC, раньше которого смена дня не нужна (см. compute_next_close_utc)
     
     # Чеклисты по тегам (ключ = текст тега, значение = TagChecklistState)
     tag_checklists: Dict[str, TagChecklistState] = field(default_factory=dict)
+    
+    # Задачи на момент последней очистки от дубликатов (см. validate_and_clean_user_state)
+    _clean_signature: Optional[Tuple] = field(default=None, init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        # Списки, переданные при создании, превращаем в ограниченные очереди
+        if not isinstance(self.service_message_ids, deque) or self.service_message_ids.maxlen != SERVICE_MESSAGE_IDS_LIMIT:
+            self.service_message_ids = deque(self.service_message_ids, maxlen=SERVICE_MESSAGE_IDS_LIMIT)
+        if not isinstance(self.tags_history, deque) or self.tags_history.maxlen != TAGS_HISTORY_LIMIT:
+            # Свежие теги в начале — при обрезке сохраняем первые, а не последние
+            self.tags_history = deque(islice(self.tags_history, TAGS_HISTORY_LIMIT), maxlen=TAGS_HISTORY_LIMIT)
+
+
+# Сколько состояний держать в памяти (давно неактивные чаты перечитываются из SQLite)
+STATE_CACHE_SIZE = 1024
+
+
+class _StateCache(OrderedDict):
+    """
+    LRU-кэш состояний: при переполнении вытесняет давно не использованные чаты.
+    Чаты с ещё не записанными сохранениями не вытесняются — пока запись
+    не дошла до SQLite, актуальное состояние есть только в кэше.
+    Вытесненное состояние, которое ещё держит кто-то (смена дня, обработчик
+    посреди await), остаётся доступным по слабой ссылке: get() возвращает
+    в кэш тот же объект, а не читает из БД вторую копию.
+    """
+
+    def __init__(self, max_size: int):
+        super().__init__()
+        self.max_size = max_size
+        # Все выданные состояния, пока на них есть ссылки (в том числе вытесненные)
+        self._live: "weakref.WeakValueDictionary[int, UserState]" = weakref.WeakValueDictionary()
+
+    def __getitem__(self, chat_id: int) -> UserState:
+        user_state = super().__getitem__(chat_id)
+        self.move_to_end(chat_id)
+        return user_state
+
+    def get(self, chat_id: int, default=None):
+        # Один поиск по словарю вместо "in" + [] на каждом попадании
+        try:
+            return self[chat_id]
+        except KeyError:
+            pass
+        # Вытеснен, но ещё используется — возвращаем в кэш тот же объект
+        user_state = self._live.get(chat_id)
+        if user_state is None:
+            return default
+        self[chat_id] = user_state
+        return user_state
+
+    def __setitem__(self, chat_id: int, user_state: UserState) -> None:
+        super().__setitem__(chat_id, user_state)
+        self.move_to_end(chat_id)
+        self._live[chat_id] = user_state
+        if len(self) > self.max_size:
+            self._evict()
+
+    def discard(self, chat_id: int) -> None:
+        """Забывает чат совсем (и в кэше, и среди используемых состояний)"""
+        self.pop(chat_id, None)
+        self._live.pop(chat_id, None)
+
+    def clear(self) -> None:
+        super().clear()
+        self._live.clear()
+
+    def _evict(self) -> None:
+        excess = len(self) - self.max_size
+        for chat_id in [cid for cid in self if cid not in _pending_states][:excess]:
+            super().__delitem__(chat_id)
+            # Снимок последней записанной строки держим только для закэшированных чатов:
+            # следующее сохранение вытесненного чата запишет строку целиком
+            _last_written_rows.pop(chat_id, None)
 
 
 # Глобальное хранилище состояний пользователей (кэш в памяти для быстрого доступа)
-STATE: Dict[int, UserState] = {}
+STATE: Dict[int, UserState] = _StateCache(STATE_CACHE_SIZE)
 
+# Сколько секунд помнить, что чата нет в БД (повторные апдейты от незнакомых чатов не идут в SQLite)
+MISSING_CHAT_TTL = 5.0
 
-def load_user_state(chat_id: int) -> Optional[UserState]:
+# chat_id -> monotonic() момента, когда строки не оказалось в БД (не больше STATE_CACHE_SIZE записей)
+_missing_chats: Dict[int, float] = {}
+
+
+def _remember_missing_chat(chat_id: int) -> None:
+    """Запоминает отсутствие чата в БД; при переполнении забывает самый старый"""
+    _missing_chats.pop(chat_id, None)
+    if len(_missing_chats) >= STATE_CACHE_SIZE:
+        del _missing_chats[next(iter(_missing_chats))]
+    _missing_chats[chat_id] = monotonic()
+
+
+_SELECT_USER_STATE_COLUMNS = """
+    business_connection_id, asked_for_time, waiting_for_time, time,
+    timezone_offset_minutes,
+    checklist_message_id, date, tasks, service_message_ids,
+    pending_task_text, pending_task_message_id, pending_service_message_ids,
+    awaiting_tag, tags_history, tags_page_index, pending_confirm_job_id,
+    tag_checklists, last_closed_date, last_opened_date, next_rollover_job_name, day_end_time
+"""
+
+_SELECT_USER_STATE_LEGACY_COLUMNS = """
+    business_connection_id, asked_for_time, waiting_for_time, time,
+    checklist_message_id, date, tasks, service_message_ids,
+    pending_task_text, pending_task_message_id, pending_service_message_ids,
+    awaiting_tag, tags_history, tags_page_index, pending_confirm_job_id,
+    tag_checklists
+"""
+
+# Колонки, которые добавляет миграция init_db (их отсутствие = старая схема)
+_NEW_SCHEMA_COLUMNS = frozenset({
+    "timezone_offset_minutes", "last_closed_date", "last_opened_date",
+    "next_rollover_job_name", "day_end_time", "next_close_utc",
+})
+
+# Схема уже проверена и новая (миграции колонки не удаляют — перепроверять не нужно)
+_schema_is_new = False
+
+
+def _has_new_fields(conn: sqlite3.Connection) -> bool:
     """
-    Возвращает состояние пользователя из SQLite (с кэшированием в памяти).
-    Если нет в БД - возвращает None.
+    Есть ли в user_state колонки новой схемы. Проверяется через PRAGMA table_info,
+    а не перехватом OperationalError на каждом запросе; положительный ответ запоминается.
     """
-    # Сначала проверяем кэш
-    if chat_id in STATE:
-        return STATE[chat_id]
-    
-    # Загружаем из SQLite
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Пытаемся загрузить с новыми полями
+    global _schema_is_new
+    if not _schema_is_new:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(user_state)")}
+        _schema_is_new = _NEW_SCHEMA_COLUMNS <= columns
+    return _schema_is_new
+
+
+def compute_next_close_utc(user_state: UserState) -> Optional[int]:
+    """
+    Вычисляет момент (unix-время UTC) ближайшей возможной смены дня:
+    локальная полночь после last_closed_date. Раньше этого момента
+    check_day_rollover для пользователя ничего не делает.
+    Возвращает None, если момент заранее неизвестен (нет day_end_time
+    или день ещё ни разу не закрывался) — такие пользователи проверяются на каждом тике.
+    """
+    if not user_state.day_end_time or not user_state.last_closed_date:
+        return None
     try:
-        cursor.execute("""
-            SELECT 
-                business_connection_id, asked_for_time, waiting_for_time, time,
-                timezone_offset_minutes,
-                checklist_message_id, date, tasks, service_message_ids,
-                pending_task_text, pending_task_message_id, pending_service_message_ids,
-                awaiting_tag, tags_history, tags_page_index, pending_confirm_job_id,
-                tag_checklists, last_closed_date, last_opened_date, next_rollover_job_name, day_end_time
-            FROM user_state
-            WHERE chat_id = ?
-        """, (chat_id,))
-        has_new_fields = True
-    except sqlite3.OperationalError:
-        # Если колонок нет - загружаем без них
-        cursor.execute("""
-            SELECT 
-                business_connection_id, asked_for_time, waiting_for_time, time,
-                checklist_message_id, date, tasks, service_message_ids,
-                pending_task_text, pending_task_message_id, pending_service_message_ids,
-                awaiting_tag, tags_history, tags_page_index, pending_confirm_job_id,
-                tag_checklists
-            FROM user_state
-            WHERE chat_id = ?
-        """, (chat_id,))
-        has_new_fields = False
-    
-    row = cursor.fetchone()
-    conn.close()
-    
-    if row is None:
+        closed_midnight = datetime.fromisoformat(user_state.last_closed_date).replace(tzinfo=timezone.utc)
+    except ValueError:
         return None
-    
-    # Распаковываем данные из БД через кортеж (избегаем проблем с индексами)
-    if has_new_fields:
-        (
-            business_connection_id,
-            asked_for_time_raw,
-            waiting_for_time_raw,
-            time,
-            timezone_offset_minutes,
-            checklist_message_id,
-            date,
-            tasks_json,
-            service_message_ids_json,
-            pending_task_text,
-            pending_task_message_id,
-            pending_service_message_ids_json,
-            awaiting_tag_raw,
-            tags_history_json,
-            tags_page_index_raw,
-            pending_confirm_job_id,
-            tag_checklists_json,
-            last_closed_date,
-            last_opened_date,
-            next_rollover_job_name,
-            day_end_time,
-        ) = row
-    else:
-        (
-            business_connection_id,
-            asked_for_time_raw,
-            waiting_for_time_raw,
-            time,
-            checklist_message_id,
-            date,
-            tasks_json,
-            service_message_ids_json,
-            pending_task_text,
-            pending_task_message_id,
-            pending_service_message_ids_json,
-            awaiting_tag_raw,
-            tags_history_json,
-            tags_page_index_raw,
-            pending_confirm_job_id,
-            tag_checklists_json,
-        ) = row
-        # Для старой схемы поля отсутствуют — выставляем дефолты
-        timezone_offset_minutes = 0
-        last_closed_date = None
-        last_opened_date = None
-        next_rollover_job_name = None
-        day_end_time = None
-    
-    # Нормализуем типы
-    asked_for_time = bool(asked_for_time_raw) if asked_for_time_raw is not None else False
-    waiting_for_time = bool(waiting_for_time_raw) if waiting_for_time_raw is not None else False
-    tags_page_index = tags_page_index_raw if tags_page_index_raw is not None else 0
-    awaiting_tag = bool(awaiting_tag_raw) if awaiting_tag_raw is not None else False
-    
-    # Десериализуем tasks из JSON в список TaskItem
-    tasks_data = json.loads(tasks_json) if tasks_json else []
+    next_local_midnight = closed_midnight + timedelta(days=1, minutes=-(user_state.timezone_offset_minutes or 0))
+    return int(next_local_midnight.timestamp())
+
+
+def _parse_tasks(tasks_data) -> List[TaskItem]:
+    """Десериализует список задач (поддерживает старый формат — список строк)"""
     tasks: List[TaskItem] = []
     for item in tasks_data:
         if isinstance(item, dict):
@@ -184,34 +274,63 @@ def load_user_state(chat_id: int) -> Optional[UserState]:
             tasks.append(TaskItem(item_id=len(tasks) + 1, text=item, done=False))
         else:
             tasks.append(TaskItem(item_id=len(tasks) + 1, text=str(item), done=False))
+    return tasks
+
+
+def _user_state_from_row(row: Tuple) -> UserState:
+    """Собирает UserState из строки SELECT (колонки _SELECT_USER_STATE_COLUMNS)"""
+    # Распаковываем данные из БД через кортеж (избегаем проблем с индексами)
+    (
+        business_connection_id,
+        asked_for_time_raw,
+        waiting_for_time_raw,
+        time,
+        timezone_offset_minutes,
+        checklist_message_id,
+        date,
+        tasks_json,
+        service_message_ids_json,
+        pending_task_text,
+        pending_task_message_id,
+        pending_service_message_ids_json,
+        awaiting_tag_raw,
+        tags_history_json,
+        tags_page_index_raw,
+        pending_confirm_job_id,
+        tag_checklists_json,
+        last_closed_date,
+        last_opened_date,
+        next_rollover_job_name,
+        day_end_time,
+    ) = row
+    
+    # Нормализуем типы (NULL в старых строках — False: bool(None) тоже False)
+    asked_for_time = bool(asked_for_time_raw)
+    waiting_for_time = bool(waiting_for_time_raw)
+    tags_page_index = tags_page_index_raw if tags_page_index_raw is not None else 0
+    awaiting_tag = bool(awaiting_tag_raw)
+    
+    # Десериализуем tasks из JSON в список TaskItem
+    tasks = _parse_tasks(_json_loads(tasks_json) if tasks_json else [])
     
     # Десериализуем service_message_ids
-    service_message_ids = json.loads(service_message_ids_json) if service_message_ids_json else []
+    service_message_ids = deque(_json_loads(service_message_ids_json) if service_message_ids_json else (), maxlen=SERVICE_MESSAGE_IDS_LIMIT)
     
     # Десериализуем pending_service_message_ids
-    pending_service_message_ids = json.loads(pending_service_message_ids_json) if pending_service_message_ids_json else []
+    pending_service_message_ids = _json_loads(pending_service_message_ids_json) if pending_service_message_ids_json else []
     
     # Десериализуем tags_history
-    tags_history = json.loads(tags_history_json) if tags_history_json else []
+    tags_history = deque(islice(_json_loads(tags_history_json) if tags_history_json else (), TAGS_HISTORY_LIMIT), maxlen=TAGS_HISTORY_LIMIT)
     
     # Десериализуем tag_checklists из JSON
     tag_checklists: Dict[str, TagChecklistState] = {}
     if tag_checklists_json:
-        tag_checklists_raw = json.loads(tag_checklists_json)
+        tag_checklists_raw = _json_loads(tag_checklists_json)
         for tag, tag_data in tag_checklists_raw.items():
-            tag_tasks_data = tag_data.get("tasks", [])
-            tag_tasks: List[TaskItem] = []
-            for item in tag_tasks_data:
-                if isinstance(item, dict):
-                    tag_tasks.append(TaskItem(**item))
-                elif isinstance(item, str):
-                    tag_tasks.append(TaskItem(item_id=len(tag_tasks) + 1, text=item, done=False))
-                else:
-                    tag_tasks.append(TaskItem(item_id=len(tag_tasks) + 1, text=str(item), done=False))
             tag_checklists[tag] = TagChecklistState(
                 title=tag_data["title"],
                 checklist_message_id=tag_data["checklist_message_id"],
-                tasks=tag_tasks,
+                tasks=_parse_tasks(tag_data.get("tasks", [])),
             )
     
     # Создаем объект UserState с явным указанием всех полей
@@ -238,6 +357,51 @@ def load_user_state(chat_id: int) -> Optional[UserState]:
         next_rollover_job_name=next_rollover_job_name,
         tag_checklists=tag_checklists,
     )
+    user_state.next_close_utc = compute_next_close_utc(user_state)
+    return user_state
+
+
+def _user_state_from_legacy_row(row: Tuple) -> UserState:
+    """
+    Собирает UserState из строки старой схемы (колонки _SELECT_USER_STATE_LEGACY_COLUMNS):
+    недостающие поля получают значения по умолчанию.
+    """
+    # timezone_offset_minutes = 0; last_closed_date, last_opened_date,
+    # next_rollover_job_name и day_end_time — None
+    return _user_state_from_row(row[:4] + (0,) + row[4:] + (None, None, None, None))
+
+
+def load_user_state(chat_id: int) -> Optional[UserState]:
+    """
+    Возвращает состояние пользователя из SQLite (с кэшированием в памяти).
+    Если нет в БД - возвращает None (отсутствие запоминается на MISSING_CHAT_TTL секунд).
+    """
+    # Сначала проверяем кэш
+    user_state = STATE.get(chat_id)
+    if user_state is not None:
+        return user_state
+    
+    # Недавно уже выяснили, что чата нет в БД
+    missing_since = _missing_chats.get(chat_id)
+    if missing_since is not None:
+        if monotonic() - missing_since < MISSING_CHAT_TTL:
+            return None
+        del _missing_chats[chat_id]
+    
+    # Загружаем из SQLite (общее постоянное соединение). _write_lock дожидается
+    # пачки, которая уже пишется в потоке: чат мог быть вытеснен из кэша,
+    # пока его последнее сохранение ещё не дошло до БД
+    with _write_lock, shared_connection() as conn:
+        has_new_fields = _has_new_fields(conn)
+        # Для старой схемы (колонок нет) загружаем без новых полей
+        columns = _SELECT_USER_STATE_COLUMNS if has_new_fields else _SELECT_USER_STATE_LEGACY_COLUMNS
+        row = conn.execute(f"SELECT {columns} FROM user_state WHERE chat_id = ?", (chat_id,)).fetchone()
+    
+    if row is None:
+        _remember_missing_chat(chat_id)
+        return None
+    
+    user_state = (_user_state_from_row if has_new_fields else _user_state_from_legacy_row)(row)
     
     # Сохраняем в кэш
     STATE[chat_id] = user_state
@@ -245,6 +409,97 @@ def load_user_state(chat_id: int) -> Optional[UserState]:
     return user_state
 
 
+# Сколько chat_id подставлять в один "WHERE chat_id IN (...)" (лимит параметров SQLite — 999)
+_SELECT_IN_CHUNK_SIZE = 500
+
+
+def _load_user_states(where: str = "", params: Tuple = ()) -> Dict[int, UserState]:
+    """
+    Загружает состояния (с необязательным условием WHERE по новым колонкам).
+    Уже закэшированные состояния берутся из STATE — они актуальнее строки в БД
+    (сохранения пишутся в SQLite с задержкой); остальные кладутся в кэш.
+    Сначала выбираются только chat_id, затем полные строки (с JSON-колонками)
+    читаются лишь для чатов, которых нет в кэше.
+    """
+    states: Dict[int, UserState] = {}
+    with shared_connection() as conn:
+        has_new_fields = _has_new_fields(conn)
+        if not has_new_fields:
+            # Старая схема: условие по новым колонкам невозможно — загружаем всех
+            where, params = "", ()
+        columns = _SELECT_USER_STATE_COLUMNS if has_new_fields else _SELECT_USER_STATE_LEGACY_COLUMNS
+        parse_row = _user_state_from_row if has_new_fields else _user_state_from_legacy_row
+        
+        missing: List[int] = []
+        for (chat_id,) in conn.execute(f"SELECT chat_id FROM user_state {where}", params):
+            user_state = STATE.get(chat_id)
+            if user_state is None:
+                missing.append(chat_id)
+            else:
+                states[chat_id] = user_state
+        
+        for start in range(0, len(missing), _SELECT_IN_CHUNK_SIZE):
+            chunk = missing[start:start + _SELECT_IN_CHUNK_SIZE]
+            placeholders = ", ".join("?" * len(chunk))
+            for row in conn.execute(f"SELECT chat_id, {columns} FROM user_state WHERE chat_id IN ({placeholders})", chunk):
+                user_state = parse_row(row[1:])
+                STATE[row[0]] = user_state
+                states[row[0]] = user_state
+    
+    # Новые пользователи, чья первая запись ещё ждёт фонового writer'а
+    for chat_id in _pending_states:
+        if chat_id not in states and chat_id in STATE:
+            states[chat_id] = STATE[chat_id]
+    
+    return states
+
+
+def load_all_user_states() -> Dict[int, UserState]:
+    """Возвращает состояния всех пользователей пакетными SELECT (вместо N вызовов load_user_state)"""
+    return _load_user_states()
+
+
+def load_scheduled_user_states() -> Dict[int, UserState]:
+    """Возвращает только пользователей с установленным временем (им нужен midnight job)"""
+    states = _load_user_states("WHERE time IS NOT NULL AND time != ''")
+    # На старой схеме _load_user_states загружает всех — фильтруем здесь
+    return {chat_id: user_state for chat_id, user_state in states.items() if user_state.time}
+
+
+def load_rollover_candidates(utc_ts: int) -> Dict[int, UserState]:
+    """
+    Возвращает только пользователей, у которых день может смениться:
+    установлено day_end_time и наступил next_close_utc (или он неизвестен).
+    Окончательное решение о закрытии дня принимает вызывающий код.
+    """
+    return _load_user_states(
+        "WHERE day_end_time IS NOT NULL AND (next_close_utc IS NULL OR next_close_utc <= ?)",
+        (utc_ts,),
+    )
+
+
+def next_rollover_after(utc_ts: int) -> Optional[int]:
+    """
+    Возвращает ближайший next_close_utc позже utc_ts среди пользователей
+    с установленным day_end_time (по БД и ещё не записанным сохранениям) или None.
+    """
+    with shared_connection() as conn:
+        if not _has_new_fields(conn):
+            # Старая схема без next_close_utc
+            return None
+        row = conn.execute(
+            "SELECT MIN(next_close_utc) FROM user_state WHERE day_end_time IS NOT NULL AND next_close_utc > ?",
+            (utc_ts,),
+        ).fetchone()
+    
+    candidates = [row[0]] if row and row[0] is not None else []
+    candidates.extend(
+        user_state.next_close_utc for user_state in _pending_states.values()
+        if user_state.day_end_time and user_state.next_close_utc is not None and user_state.next_close_utc > utc_ts
+    )
+    return min(candidates, default=None)
+
+
 def clean_tasks_list(tasks: List[TaskItem]) -> List[TaskItem]:
     """
     Очищает список задач от дубликатов:
@@ -256,37 +511,56 @@ def clean_tasks_list(tasks: List[TaskItem]) -> List[TaskItem]:
     if not tasks:
         return tasks
     
-    # Шаг 1: Удаляем дубликаты по item_id (оставляем первую задачу с таким item_id)
+    # Один проход: item_id задачи запоминается, даже если она отброшена как дубликат
+    # по тексту — так результат совпадает с очисткой сначала по item_id, потом по тексту
     seen_item_ids = set()
-    clean_by_id = []
-    for task in tasks:
-        if task.item_id not in seen_item_ids:
-            clean_by_id.append(task)
-            seen_item_ids.add(task.item_id)
-    
-    # Шаг 2: Удаляем дубликаты по тексту (оставляем первую задачу с таким текстом)
     seen_texts = set()
     clean = []
-    for task in clean_by_id:
-        # Нормализуем текст для сравнения (убираем пробелы по краям, приводим к нижнему регистру)
-        normalized_text = task.text.strip().lower()
-        if normalized_text not in seen_texts:
-            clean.append(task)
-            seen_texts.add(normalized_text)
+    for task in tasks:
+        item_id = task.item_id
+        if item_id in seen_item_ids:
+            continue
+        seen_item_ids.add(item_id)
+        # Нормализованный текст кэшируется в задаче — при повторных сохранениях не пересчитывается
+        normalized_text = task.norm()
+        if normalized_text in seen_texts:
+            continue
+        seen_texts.add(normalized_text)
+        clean.append(task)
     
     return clean
 
 
+# То, по чему clean_tasks_list ищет дубликаты
+_TASK_DEDUP_KEY = attrgetter("item_id", "text")
+
+
+def _tasks_signature(user_state: UserState) -> Tuple:
+    """(item_id, text) всех задач дня и теговых чеклистов — собирается на уровне C, без цикла Python по задачам"""
+    return (
+        tuple(map(_TASK_DEDUP_KEY, user_state.tasks)),
+        tuple((tag, tuple(map(_TASK_DEDUP_KEY, tag_state.tasks))) for tag, tag_state in user_state.tag_checklists.items()),
+    )
+
+
 def validate_and_clean_user_state(user_state: UserState) -> None:
     """
     Валидирует и очищает состояние пользователя перед сохранением:
     - Удаляет дубликаты задач по item_id и тексту
     - Применяется к user_state.tasks и user_state.tag_checklists[tag].tasks
+    Если задачи не менялись с прошлой очистки, проход пропускается.
     """
+    signature = _tasks_signature(user_state)
+    if signature == user_state._clean_signature:
+        return
+    
+    removed = False
+    
     # Очищаем дневные задачи
     original_count = len(user_state.tasks)
     user_state.tasks = clean_tasks_list(user_state.tasks)
     if len(user_state.tasks) != original_count:
+        removed = True
         logger.warning(f"🧹 Очищены дневные задачи: было {original_count}, стало {len(user_state.tasks)}")
     
     # Очищаем задачи в теговых чеклистах
@@ -294,106 +568,404 @@ def validate_and_clean_user_state(user_state: UserState) -> None:
         original_count = len(tag_state.tasks)
         tag_state.tasks = clean_tasks_list(tag_state.tasks)
         if len(tag_state.tasks) != original_count:
+            removed = True
             logger.warning(f"🧹 Очищены задачи в теговом чеклисте '{tag}': было {original_count}, стало {len(tag_state.tasks)}")
+    
+    user_state._clean_signature = _tasks_signature(user_state) if removed else signature
+
+
+# Пакетная запись в SQLite:
+# save_user_state сразу обновляет STATE (источник истины для процесса)
+# и помечает чат "грязным" в _pending_states — повторное сохранение того же чата
+# ничего не добавляет. Фоновый writer после WRITE_COALESCE_DELAY секунд
+# сериализует каждое грязное состояние один раз (в event loop, где его меняют
+# обработчики) и пишет строки одной транзакцией в отдельном потоке.
+WRITE_COALESCE_DELAY = 0.05  # секунды
+
+# Пауза перед повторной записью пачки после ошибки SQLite (например, БД занята)
+WRITE_RETRY_DELAY = 1.0  # секунды
+
+_pending_states: Dict[int, UserState] = {}
+_pending_event: Optional[asyncio.Event] = None
+_writer_task: Optional[asyncio.Task] = None
+
+# Захватывается в event loop ДО передачи пачки в поток и освобождается потоком
+# после commit. Так синхронные flush_now/flush_pending_writes всегда ждут уже
+# переданную в поток, более старую пачку и не могут её "обогнать".
+_write_lock = threading.Lock()
+
+_INSERT_USER_STATE_SQL = """
+    INSERT OR REPLACE INTO user_state (
+        chat_id, business_connection_id, asked_for_time, waiting_for_time, time,
+        timezone_offset_minutes, checklist_message_id, date, tasks, service_message_ids,
+        pending_task_text, pending_task_message_id, pending_service_message_ids,
+        awaiting_tag, tags_history, tags_page_index, pending_confirm_job_id,
+        tag_checklists, last_closed_date, last_opened_date, next_rollover_job_name, day_end_time,
+        next_close_utc
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_INSERT_USER_STATE_LEGACY_SQL = """
+    INSERT OR REPLACE INTO user_state (
+        chat_id, business_connection_id, asked_for_time, waiting_for_time, time,
+        checklist_message_id, date, tasks, service_message_ids,
+        pending_task_text, pending_task_message_id, pending_service_message_ids,
+        awaiting_tag, tags_history, tags_page_index, pending_confirm_job_id,
+        tag_checklists
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Позиции значений старой схемы внутри строки новой схемы
+# (без timezone_offset_minutes и полей после tag_checklists)
+_LEGACY_ROW_INDEXES = (0, 1, 2, 3, 4, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17)
+
+# Имена колонок в порядке значений строки (для UPDATE только изменившихся полей)
+_USER_STATE_COLUMNS = (
+    "chat_id", "business_connection_id", "asked_for_time", "waiting_for_time", "time",
+    "timezone_offset_minutes", "checklist_message_id", "date", "tasks", "service_message_ids",
+    "pending_task_text", "pending_task_message_id", "pending_service_message_ids",
+    "awaiting_tag", "tags_history", "tags_page_index", "pending_confirm_job_id",
+    "tag_checklists", "last_closed_date", "last_opened_date", "next_rollover_job_name", "day_end_time",
+    "next_close_utc",
+)
+
+# Полная запись строки: существующая строка обновляется на месте (upsert, SQLite 3.24+),
+# а не удаляется и вставляется заново, как при INSERT OR REPLACE
+if sqlite3.sqlite_version_info >= (3, 24, 0):
+    _UPSERT_USER_STATE_SQL = f"""
+    INSERT INTO user_state ({", ".join(_USER_STATE_COLUMNS)})
+    VALUES ({", ".join("?" * len(_USER_STATE_COLUMNS))})
+    ON CONFLICT(chat_id) DO UPDATE SET {", ".join(f"{column} = excluded.{column}" for column in _USER_STATE_COLUMNS[1:])}
+"""
+else:
+    _UPSERT_USER_STATE_SQL = _INSERT_USER_STATE_SQL
+
+# Последняя строка, отправленная в SQLite, по chat_id. Следующее сохранение
+# сравнивается с ней и пишет только изменившиеся колонки
+_last_written_rows: Dict[int, Tuple] = {}
+
+# Запись одной строки: (строка, индексы изменившихся колонок или None — записать целиком)
+_RowWrite = Tuple[Tuple, Optional[Tuple[int, ...]]]
+
+
+def _tasks_to_json(tasks: List[TaskItem]) -> List[dict]:
+    """
+    Список задач для JSON. Значения по умолчанию не пишутся ("done": false) —
+    при загрузке их подставляет TaskItem
+    """
+    return [
+        {"item_id": task.item_id, "text": task.text, "done": True} if task.done
+        else {"item_id": task.item_id, "text": task.text}
+        for task in tasks
+    ]
+
+
+def _serialize_user_state(chat_id: int, user_state: UserState) -> Tuple:
+    """Готовит строку user_state для INSERT (в порядке колонок _INSERT_USER_STATE_SQL)"""
+    # Сериализуем tasks в JSON (список словарей)
+    tasks_json = _tasks_to_json(user_state.tasks)
+    
+    # Сериализуем tag_checklists в JSON (пустой список задач не пишется — при загрузке он по умолчанию)
+    tag_checklists_json = {}
+    for tag, tag_state in user_state.tag_checklists.items():
+        tag_json = {
+            "title": tag_state.title,
+            "checklist_message_id": tag_state.checklist_message_id,
+        }
+        if tag_state.tasks:
+            tag_json["tasks"] = _tasks_to_json(tag_state.tasks)
+        tag_checklists_json[tag] = tag_json
+    
+    return (
+        chat_id,
+        user_state.business_connection_id,
+        1 if user_state.asked_for_time else 0,
+        1 if user_state.waiting_for_time else 0,
+        user_state.time,
+        user_state.timezone_offset_minutes,
+        user_state.checklist_message_id,
+        user_state.date,
+        _json_dumps(tasks_json),
+        _json_dumps(list(user_state.service_message_ids)),
+        user_state.pending_task_text,
+        user_state.pending_task_message_id,
+        _json_dumps(user_state.pending_service_message_ids),
+        1 if user_state.awaiting_tag else 0,
+        _json_dumps(list(user_state.tags_history)),
+        user_state.tags_page_index,
+        user_state.pending_confirm_job_id,
+        _json_dumps(tag_checklists_json),
+        user_state.last_closed_date,
+        user_state.last_opened_date,
+        user_state.next_rollover_job_name,
+        user_state.day_end_time,
+        user_state.next_close_utc,
+    )
+
+
+def _prepare_write(chat_id: int, user_state: UserState) -> Optional[_RowWrite]:
+    """
+    Сериализует состояние и сравнивает строку с последней записанной.
+    Возвращает None, если ничего не изменилось; индексы колонок — если строка
+    уже есть в БД; None вместо индексов — если строку нужно записать целиком.
+    """
+    row = _serialize_user_state(chat_id, user_state)
+    previous = _last_written_rows.get(chat_id)
+    # Базу обновляем сразу (в потоке event loop), а не после записи:
+    # следующая пачка сравнивается с тем, что уже стоит в очереди на запись
+    _last_written_rows[chat_id] = row
+    if previous is None:
+        return row, None
+    changed = tuple(i for i in range(1, len(row)) if row[i] != previous[i])
+    if not changed:
+        return None
+    return row, changed
+
+
+def _forget_written_rows(writes: List[_RowWrite]) -> None:
+    """После ошибки записи следующее сохранение этих чатов пойдёт целиком"""
+    for row, _ in writes:
+        _last_written_rows.pop(row[0], None)
+
+
+def _requeue_writes(states: Dict[int, UserState], writes: List[_RowWrite]) -> None:
+    """
+    Возвращает в очередь состояния из незаписанной пачки — они снова защищены
+    от вытеснения из кэша и будут записаны следующей пачкой или flush_pending_writes.
+    Более новое сохранение того же чата, уже стоящее в очереди, не перетираем.
+    """
+    _forget_written_rows(writes)
+    for chat_id, user_state in states.items():
+        _pending_states.setdefault(chat_id, user_state)
+    if _pending_event is not None:
+        _pending_event.set()
+
+
+def _write_rows(writes: List[_RowWrite]) -> None:
+    """
+    Записывает строки user_state в SQLite одной транзакцией.
+    Для строк с известными изменениями выполняется UPDATE только этих колонок;
+    строки с одинаковым набором изменений и новые строки пишутся через executemany.
+    """
+    with shared_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            has_new_fields = _has_new_fields(conn)
+            # Блокировку записи берём сразу: пачка пишется одной транзакцией с одним commit,
+            # и она не упирается в SQLITE_BUSY при повышении блокировки посреди пачки
+            conn.execute("BEGIN IMMEDIATE")
+            if has_new_fields:
+                # Строки группируются по виду запроса: один executemany на группу
+                inserts: List[Tuple] = []
+                updates: Dict[Tuple[int, ...], List[Tuple]] = {}
+                for row, changed in writes:
+                    if changed is None:
+                        inserts.append(row)
+                    else:
+                        updates.setdefault(changed, []).append(row)
+                
+                for changed, rows in updates.items():
+                    assignments = ", ".join(f"{_USER_STATE_COLUMNS[i]} = ?" for i in changed)
+                    update_sql = f"UPDATE user_state SET {assignments} WHERE chat_id = ?"
+                    cursor.executemany(update_sql, [[row[i] for i in changed] + [row[0]] for row in rows])
+                    if cursor.rowcount == len(rows):
+                        continue
+                    # Какой-то строки нет (удалена в обход бота) — повторяем группу построчно,
+                    # недостающие строки пишем целиком (повторный UPDATE ничего не меняет)
+                    for row in rows:
+                        cursor.execute(update_sql, [row[i] for i in changed] + [row[0]])
+                        if not cursor.rowcount:
+                            inserts.append(row)
+                
+                if inserts:
+                    cursor.executemany(_UPSERT_USER_STATE_SQL, inserts)
+            else:
+                # Если колонок нет - сохраняем без них (миграция добавит их при следующем запуске)
+                cursor.executemany(
+                    _INSERT_USER_STATE_LEGACY_SQL,
+                    [tuple(row[i] for i in _LEGACY_ROW_INDEXES) for row, _ in writes],
+                )
+            
+            conn.commit()
+        except Exception:
+            # Соединение общее — не оставляем на нём незавершённую транзакцию
+            conn.rollback()
+            raise
+
+
+def _write_rows_and_release(writes: List[_RowWrite], claim: threading.Lock) -> None:
+    """
+    Выполняется в потоке: пишет пачку и освобождает _write_lock.
+    Если writer отменили раньше, чем поток стартовал, пачку (и замок) уже забрал
+    сам writer — тогда claim занят и поток ничего не делает.
+    """
+    if not claim.acquire(blocking=False):
+        return
+    try:
+        _write_rows(writes)
+    finally:
+        _write_lock.release()
 
 
 def save_user_state(chat_id: int, user_state: UserState) -> None:
     """
     Сохраняет состояние пользователя в SQLite и обновляет кэш.
     Перед сохранением валидирует и очищает данные (удаляет дубликаты по item_id и тексту).
+    Если запущен фоновый writer, запись в SQLite выполняется им пакетно,
+    иначе (скрипты, тесты) — сразу.
     """
     # Валидируем и очищаем данные перед сохранением
     validate_and_clean_user_state(user_state)
     
-    # Сохраняем в кэш
-    STATE[chat_id] = user_state
-    
-    # Сохраняем в SQLite
-    conn = get_connection()
-    cursor = conn.cursor()
+    # Момент следующей смены дня пересчитываем при каждом сохранении:
+    # так он всегда соответствует day_end_time, смещению и last_closed_date
+    user_state.next_close_utc = compute_next_close_utc(user_state)
     
-    # Сериализуем tasks в JSON (список словарей)
-    tasks_json = [{"item_id": task.item_id, "text": task.text, "done": task.done} for task in user_state.tasks]
+    # Сериализация откладывается до записи: серия сохранений одного чата
+    # внутри окна склейки сериализуется один раз
+    if _writer_task is not None:
+        _pending_states[chat_id] = user_state
+        _pending_event.set()
     
-    # Сериализуем tag_checklists в JSON
-    tag_checklists_json = {}
-    for tag, tag_state in user_state.tag_checklists.items():
-        tag_tasks_json = [{"item_id": task.item_id, "text": task.text, "done": task.done} for task in tag_state.tasks]
-        tag_checklists_json[tag] = {
-            "title": tag_state.title,
-            "checklist_message_id": tag_state.checklist_message_id,
-            "tasks": tag_tasks_json
-        }
+    # Сохраняем в кэш (после _pending_states — чтобы чат не был тут же вытеснен)
+    STATE[chat_id] = user_state
+    _missing_chats.pop(chat_id, None)
     
-    # Пытаемся сохранить с новыми полями
+    if _writer_task is None:
+        write = _prepare_write(chat_id, user_state)
+        if write is not None:
+            try:
+                _write_rows([write])
+            except Exception:
+                _forget_written_rows([write])
+                raise
+
+
+def flush_now(chat_id: int) -> bool:
+    """
+    Синхронно записывает отложенное сохранение одного чата.
+    Нужна перед прямыми SQL-запросами к строке чата и там, где изменения
+    должны попасть в БД до ответа пользователю.
+    Всегда дожидается пачки, которую фоновый writer уже пишет в потоке, —
+    даже если у чата нет отложенной записи или в ней ничего не изменилось.
+    Возвращает True, если была отложенная запись.
+    """
+    user_state = _pending_states.pop(chat_id, None)
+    write = _prepare_write(chat_id, user_state) if user_state is not None else None
+    # После flush_now строку меняют прямым SQL — следующее сохранение пишем целиком
+    _last_written_rows.pop(chat_id, None)
+    try:
+        with _write_lock:
+            if write is not None:
+                _write_rows([write])
+    except Exception as e:
+        _requeue_writes({chat_id: user_state}, [write])
+        logger.error(f"❌ Ошибка при записи состояния chat_id={chat_id} в SQLite: {e}", exc_info=True)
+    return user_state is not None
+
+
+def flush_pending_writes() -> int:
+    """
+    Синхронно записывает в SQLite все отложенные сохранения.
+    При ошибке состояния остаются в очереди.
+    Возвращает количество записанных строк.
+    """
+    if not _pending_states:
+        return 0
+    states, writes = _take_pending_rows()
+    try:
+        with _write_lock:
+            _write_rows(writes)
+    except Exception as e:
+        _requeue_writes(states, writes)
+        logger.error(f"❌ Ошибка при записи {len(writes)} состояний в SQLite: {e}", exc_info=True)
+        return 0
+    return len(writes)
+
+
+def _take_pending_rows() -> Tuple[Dict[int, UserState], List[_RowWrite]]:
+    """
+    Забирает все грязные состояния и готовит записи только для изменившихся строк.
+    Возвращает и сами состояния — чтобы при ошибке записи вернуть их в очередь.
+    """
+    states = {}
+    writes = []
+    for chat_id, user_state in _pending_states.items():
+        write = _prepare_write(chat_id, user_state)
+        if write is not None:
+            states[chat_id] = user_state
+            writes.append(write)
+    _pending_states.clear()
+    return states, writes
+
+
+async def _writer_loop(wakeup: asyncio.Event) -> None:
+    """Фоновый writer: ждёт сохранений, выдерживает окно склейки и пишет пачкой"""
+    while True:
+        await wakeup.wait()
+        # Окно склейки: серия сохранений одного чата превращается в одну запись
+        await asyncio.sleep(WRITE_COALESCE_DELAY)
+        wakeup.clear()
+        if not _pending_states:
+            continue
+        states, batch = _take_pending_rows()
+        if not batch:
+            continue
+        # Кто первым займёт claim — поток или отменённый writer, — тот и
+        # освобождает _write_lock
+        claim = threading.Lock()
+        _write_lock.acquire()
+        try:
+            await asyncio.to_thread(_write_rows_and_release, batch, claim)
+            logger.debug(f"💾 Записано состояний в SQLite: {len(batch)}")
+        except asyncio.CancelledError:
+            # Остановка бота: если поток ещё не начал запись, замок отпускаем сами,
+            # иначе его отпустит поток. Пачку в любом случае возвращаем в очередь —
+            # её допишет flush_pending_writes, дождавшись потока на _write_lock
+            if claim.acquire(blocking=False):
+                _write_lock.release()
+            _requeue_writes(states, batch)
+            raise
+        except Exception as e:
+            _requeue_writes(states, batch)
+            logger.error(
+                f"❌ Ошибка при записи {len(batch)} состояний в SQLite: {e}, "
+                f"повтор через {WRITE_RETRY_DELAY} с",
+                exc_info=True,
+            )
+            await asyncio.sleep(WRITE_RETRY_DELAY)
+
+
+def start_state_writer() -> None:
+    """Запускает фоновый writer (вызывается из работающего event loop)"""
+    global _pending_event, _writer_task
+    if _writer_task is not None:
+        return
+    _pending_event = asyncio.Event()
+    _writer_task = asyncio.create_task(_writer_loop(_pending_event))
+    logger.info("✅ Фоновая запись состояний в SQLite запущена")
+
+
+async def stop_state_writer() -> None:
+    """Останавливает фоновый writer и дописывает всё, что осталось в очереди"""
+    global _pending_event, _writer_task
+    if _writer_task is None:
+        return
+    _writer_task.cancel()
     try:
-        cursor.execute("""
-            INSERT OR REPLACE INTO user_state (
-                chat_id, business_connection_id, asked_for_time, waiting_for_time, time,
-                timezone_offset_minutes, checklist_message_id, date, tasks, service_message_ids,
-                pending_task_text, pending_task_message_id, pending_service_message_ids,
-                awaiting_tag, tags_history, tags_page_index, pending_confirm_job_id,
-                tag_checklists, last_closed_date, last_opened_date, next_rollover_job_name, day_end_time
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            chat_id,
-            user_state.business_connection_id,
-            1 if user_state.asked_for_time else 0,
-            1 if user_state.waiting_for_time else 0,
-            user_state.time,
-            user_state.timezone_offset_minutes,
-            user_state.checklist_message_id,
-            user_state.date,
-            json.dumps(tasks_json, ensure_ascii=False),
-            json.dumps(user_state.service_message_ids, ensure_ascii=False),
-            user_state.pending_task_text,
-            user_state.pending_task_message_id,
-            json.dumps(user_state.pending_service_message_ids, ensure_ascii=False),
-            1 if user_state.awaiting_tag else 0,
-            json.dumps(user_state.tags_history, ensure_ascii=False),
-            user_state.tags_page_index,
-            user_state.pending_confirm_job_id,
-            json.dumps(tag_checklists_json, ensure_ascii=False),
-            user_state.last_closed_date,
-            user_state.last_opened_date,
-            user_state.next_rollover_job_name,
-            user_state.day_end_time,
-        ))
-    except sqlite3.OperationalError:
-        # Если колонок нет - сохраняем без них (миграция добавит их при следующем запуске)
-        cursor.execute("""
-            INSERT OR REPLACE INTO user_state (
-                chat_id, business_connection_id, asked_for_time, waiting_for_time, time,
-                checklist_message_id, date, tasks, service_message_ids,
-                pending_task_text, pending_task_message_id, pending_service_message_ids,
-                awaiting_tag, tags_history, tags_page_index, pending_confirm_job_id,
-                tag_checklists
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            chat_id,
-            user_state.business_connection_id,
-            1 if user_state.asked_for_time else 0,
-            1 if user_state.waiting_for_time else 0,
-            user_state.time,
-            user_state.checklist_message_id,
-            user_state.date,
-            json.dumps(tasks_json, ensure_ascii=False),
-            json.dumps(user_state.service_message_ids, ensure_ascii=False),
-            user_state.pending_task_text,
-            user_state.pending_task_message_id,
-            json.dumps(user_state.pending_service_message_ids, ensure_ascii=False),
-            1 if user_state.awaiting_tag else 0,
-            json.dumps(user_state.tags_history, ensure_ascii=False),
-            user_state.tags_page_index,
-            user_state.pending_confirm_job_id,
-            json.dumps(tag_checklists_json, ensure_ascii=False),
-        ))
-    
-    conn.commit()
-    conn.close()
-
-
-def set_user_time_info(chat_id: int, local_time_str: str) -> bool:
+        await _writer_task
+    except asyncio.CancelledError:
+        pass
+    flushed = flush_pending_writes()
+    _writer_task = None
+    _pending_event = None
+    if _pending_states:
+        logger.error(f"❌ При остановке не удалось записать в SQLite состояний: {len(_pending_states)}")
+    logger.info(f"✅ Фоновая запись состояний остановлена (дописано строк: {flushed})")
+
+
+def set_user_time_info(chat_id: int, local_time_str: str, now_utc: Optional[datetime] = None) -> bool:
     """
     Вычисляет и сохраняет информацию о времени пользователя:
     - timezone_offset_minutes (UTC-смещение)
@@ -401,14 +973,12 @@ def set_user_time_info(chat_id: int, local_time_str: str) -> bool:
     - date (локальная дата пользователя)
     - last_closed_date = date (сбрасывает на текущую дату, если не установлено)
     
+    now_utc — момент ввода времени (если вызывающий код уже его получил).
     Возвращает True если время успешно установлено, False если ошибка парсинга.
     """
-    import logging
+    # helpers_* сами импортируют state — импортируем их здесь, чтобы избежать цикла
     from helpers_text import parse_time_string
     from helpers_daily import compute_local_datetime_and_offset
-    from datetime import datetime
-    
-    logger = logging.getLogger(__name__)
     
     # Парсим время
     parsed = parse_time_string(local_time_str)
@@ -421,7 +991,8 @@ def set_user_time_info(chat_id: int, local_time_str: str) -> bool:
         return False
     
     # Вычисляем локальное время и смещение
-    now_utc = datetime.utcnow()
+    if now_utc is None:
+        now_utc = datetime.now(timezone.utc)
     try:
         local_dt, utc_offset_minutes = compute_local_datetime_and_offset(now_utc, parsed)
     except Exception as e:
@@ -456,9 +1027,13 @@ def delete_user_state(chat_id: int) -> bool:
     Возвращает True, если запись была удалена, False если не найдена.
     """
     # Удаляем из кэша
-    if chat_id in STATE:
-        del STATE[chat_id]
+    STATE.discard(chat_id)
+    
+    # Отбрасываем отложенную запись, чтобы она не воскресила удалённую строку,
+    # и дожидаемся пачки, которая уже пишется в потоке
+    _pending_states.pop(chat_id, None)
+    _last_written_rows.pop(chat_id, None)
     
     # Удаляем из БД
-    from db import delete_user_state as db_delete_user_state
-    return db_delete_user_state(chat_id)
+    with _write_lock:
+        return db_delete_user_state(chat_id)
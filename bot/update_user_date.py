@@ -9,12 +9,13 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent))
 
 from db import get_connection
-from state import load_user_state, save_user_state
+from state import UserState, load_user_state, load_all_user_states, save_user_state
 from helpers_text import get_user_local_date
 
-def update_user_date(chat_id: int):
-    """Обновляет дату пользователя на актуальную"""
-    user_state = load_user_state(chat_id)
+def update_user_date(chat_id: int, user_state: UserState = None):
+    """Обновляет дату пользователя на актуальную (user_state — уже загруженное состояние)"""
+    if user_state is None:
+        user_state = load_user_state(chat_id)
     if not user_state:
         print(f"❌ Пользователь chat_id={chat_id} не найден")
         return False
@@ -40,11 +41,10 @@ if __name__ == "__main__":
         chat_id = int(sys.argv[1])
         update_user_date(chat_id)
     else:
-        # Обновляем всех пользователей
-        from db import get_all_chat_ids
-        chat_ids = get_all_chat_ids()
-        print(f"Найдено пользователей: {len(chat_ids)}")
-        for chat_id in chat_ids:
-            update_user_date(chat_id)
+        # Обновляем всех пользователей (все состояния — одним запросом)
+        user_states = load_all_user_states()
+        print(f"Найдено пользователей: {len(user_states)}")
+        for chat_id, user_state in user_states.items():
+            update_user_date(chat_id, user_state)
             print()
 
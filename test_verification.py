@@ -14,7 +14,7 @@ import sys
 import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'bot'))
 
-from state import UserState, TaskItem, TagChecklistState, clean_tasks_list, validate_and_clean_user_state
+from state import UserState, TaskItem, TagChecklistState, clean_tasks_list, validate_and_clean_user_state, compute_next_close_utc
 from helpers_text import normalize_tag
 from datetime import datetime, timedelta
 import logging
@@ -42,6 +42,15 @@ def test_clean_tasks_list():
     assert cleaned[1].item_id == 2, "Вторая задача должна иметь item_id=2"
     assert cleaned[0].text == "суп", "Первая задача должна быть 'суп'"
     
+    # item_id задачи, отброшенной как дубликат по тексту, тоже считается занятым
+    tasks = [
+        TaskItem(item_id=1, text="суп", done=False),
+        TaskItem(item_id=2, text=" Суп ", done=False),  # Дубликат по тексту
+        TaskItem(item_id=2, text="хлеб", done=False),  # Дубликат по item_id
+    ]
+    cleaned = clean_tasks_list(tasks)
+    assert [task.item_id for task in cleaned] == [1], f"Ожидалась только задача 1, получено {cleaned}"
+    
     print("✅ Тест пройден: дубликаты удалены корректно")
 
 
@@ -152,6 +161,52 @@ def test_date_format():
     print(f"✅ Тест пройден: формат даты корректен ({test_date} → {result})")
 
 
+def test_next_close_utc():
+    """Тест вычисления момента следующей смены дня"""
+    print("\n🧪 ТЕСТ 6: Момент следующей смены дня (next_close_utc)")
+    
+    from datetime import timezone
+    
+    user_state = UserState(
+        business_connection_id="test_conn",
+        day_end_time="00:00",
+        timezone_offset_minutes=180,  # UTC+3
+        last_closed_date="2025-01-01",
+    )
+    
+    # Локальная полночь 2025-01-02 в UTC+3 — это 2025-01-01 21:00 UTC
+    expected = int(datetime(2025, 1, 1, 21, 0, tzinfo=timezone.utc).timestamp())
+    result = compute_next_close_utc(user_state)
+    assert result == expected, f"Ожидалось {expected}, получено {result}"
+    
+    # День ещё не закрывался — момент неизвестен, пользователь проверяется на каждом тике
+    user_state.last_closed_date = None
+    assert compute_next_close_utc(user_state) is None, "Без last_closed_date должен быть None"
+    
+    print(f"✅ Тест пройден: next_close_utc вычисляется корректно ({result})")
+
+
+def test_state_cache_keeps_live_states():
+    """Тест LRU-кэша: вытесненное, но используемое состояние не раздваивается"""
+    print("\n🧪 ТЕСТ 7: Вытеснение из кэша состояний")
+    
+    from state import _StateCache
+    
+    cache = _StateCache(2)
+    held = UserState(business_connection_id="held")
+    cache[1] = held
+    cache[2] = UserState(business_connection_id="b")
+    cache[3] = UserState(business_connection_id="c")  # Вытесняет чат 1
+    
+    assert 1 not in cache, "Чат 1 должен быть вытеснен"
+    assert cache.get(1) is held, "Используемое состояние должно вернуться тем же объектом"
+    
+    cache.discard(1)
+    assert cache.get(1) is None, "После discard состояние не должно возвращаться"
+    
+    print("✅ Тест пройден: используемые состояния не копируются")
+
+
 def run_all_tests():
     """Запускает все тесты"""
     print("=" * 60)
@@ -164,6 +219,8 @@ def run_all_tests():
         test_sync_logic,
         test_validate_and_clean,
         test_date_format,
+        test_next_close_utc,
+        test_state_cache_keeps_live_states,
     ]
     
     passed = 0